@@ -0,0 +1,106 @@
+# Copyright (c) 2010 ActiveState Software Inc. All rights reserved.
+
+"""asyncio counterparts of the process execution wrappers in _proc
+
+This module requires Python 3.5 or later.
+"""
+
+import asyncio
+import signal
+
+from applib._proc import RunNonZeroReturn, RunTimedout, RunLimitExceeded
+from applib._proc import _prepare_cmd, _popen_kwargs, _signallers, _killpg
+from applib._proc import _Restrictions
+
+__all__ = ['arun']
+
+
+async def arun(cmd, merge_streams=False, timeout=None, env=None, grace=None,
+               process_group=False, limits=None, nice=None, ionice=None,
+               cgroup=None, cwd=None):
+    """Coroutine version of ``run``
+
+    Arguments, return value and exceptions are the same as that of ``run``,
+    but the event loop is not blocked while the command runs.
+
+    Unlike ``run``, a timed out process is never left running: if it does not
+    exit on SIGTERM within `grace` seconds (immediately, if `grace` is None),
+    it is killed. The same happens when the coroutine is cancelled. Note that
+    asyncio waits for the output pipes to be closed as well; use
+    `process_group` if the command spawns children that may outlive it.
+    """
+    cmd, shell = _prepare_cmd(cmd)
+    restrictions = _Restrictions.create(limits, nice, ionice, cgroup)
+    kwargs = dict(
+        env=env, cwd=cwd, stdout=asyncio.subprocess.PIPE,
+        stderr=(asyncio.subprocess.STDOUT if merge_streams
+                else asyncio.subprocess.PIPE),
+        **_popen_kwargs(process_group, restrictions))
+    if shell:
+        p = await asyncio.create_subprocess_shell(cmd, **kwargs)
+    else:
+        p = await asyncio.create_subprocess_exec(*cmd, **kwargs)
+    if restrictions:
+        restrictions.apply_to(p)
+
+    # collected as it is read, so that the output is available for
+    # RunTimedout as well
+    stdout, stderr = bytearray(), bytearray()
+    tasks = [p.wait(), _drain(p.stdout, stdout)]
+    if not merge_streams:
+        tasks.append(_drain(p.stderr, stderr))
+
+    try:
+        try:
+            await asyncio.wait_for(asyncio.gather(*tasks), timeout or None)
+        except asyncio.TimeoutError:
+            actions = await _stop(p, grace, process_group)
+            raise RunTimedout(
+                cmd, timeout, bytes(stdout),
+                None if merge_streams else bytes(stderr),
+                actions, cwd)
+    finally:
+        if p.returncode is None:
+            # cancelled
+            _signallers(p, process_group)[2]()
+            await p.wait()
+
+    if p.returncode != 0:
+        output = (bytes(stdout), None if merge_streams else bytes(stderr))
+        exceeded = restrictions and restrictions.exceeded(p.returncode)
+        if exceeded:
+            raise RunLimitExceeded(p, cmd, *(output + exceeded), cwd=cwd)
+        raise RunNonZeroReturn(p, cmd, *(output + (cwd,)))
+    return bytes(stdout), bytes(stderr)
+
+
+async def _drain(stream, buf):
+    """Read `stream` till EOF into the bytearray `buf`"""
+    while True:
+        data = await stream.read(64*1024)
+        if not data:
+            break
+        buf.extend(data)
+
+
+async def _stop(p, grace, process_group):
+    """Coroutine version of ``_proc._stop``"""
+    target, terminate, kill = _signallers(p, process_group)
+
+    terminate()
+    actions = ['sent SIGTERM to {0}'.format(target)]
+
+    grace = grace or 0
+    try:
+        await asyncio.wait_for(p.wait(), grace)
+    except asyncio.TimeoutError:
+        kill()
+        actions.append('still running after {0} seconds of grace; '
+                       'sent SIGKILL to {1}'.format(grace, target))
+        await p.wait()
+    else:
+        if process_group and _killpg(p, signal.SIGKILL):
+            # the leader exited, but some of its children did not
+            actions.append('sent SIGKILL to the remaining members of '
+                           '{0}'.format(target))
+    return actions
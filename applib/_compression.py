@@ -3,21 +3,53 @@
 import sys
 import os
 from os import path
+import stat
 import tarfile
 import zipfile
-from contextlib import closing
+import gzip
+import bz2
+import struct
+import mmap
+import threading
+import time
+import zlib
+import shutil
+import collections
+import tempfile
+from tempfile import SpooledTemporaryFile
+from contextlib import closing, contextmanager
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma  # Python < 3.3
+    except ImportError:
+        lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # optional; needed for .tar.zst files
+
+import six
 
 from applib import sh
 
-__all__ = ['implementors']
+__all__ = ['implementors', 'formats', 'sniff']
+
+_CHUNK_SIZE = 1024*1024
+_SPOOL_SIZE = 4*1024*1024  # deflated data kept in memory, per member
+_HAS_ZDICT = sys.version_info[:2] >= (3, 3)
 
 
 class CompressedFile:
     
-    def __init__(self, filename):
+    def __init__(self, filename, workers=1):
         self.filename = filename
+        self.workers = workers  # None for as many as concurrent.futures likes
+        # name of the directory created for archives with several toplevels
+        self.basename = _archive_basename(filename)
 
-    def extractall_with_single_toplevel(self, f, names):
+    def extractall_with_single_toplevel(self, f, names, dest='.'):
         """Same as ``extractall`` but ensures a single toplevel directory
 
         Some compressed archives do not stick to the convension of having a
@@ -31,6 +63,7 @@ class CompressedFile:
 
         - f:     tarfile/zipefile file object
         - names: List of filenames in the archive
+        - dest:  Directory to extract to
 
         Return the absolute path to the toplevel directory.
         """
@@ -39,35 +72,60 @@ class CompressedFile:
         if len(toplevels) == 0:
             raise sh.PackError('archive is empty')
         elif len(toplevels) > 1:
-            toplevel = _archive_basename(self.filename)
+            toplevel = path.join(dest, self.basename)
             os.mkdir(toplevel)
-            with sh.cd(toplevel):
-                f.extractall()
+            self._extractall(f, toplevel)
             return path.abspath(toplevel)
         else:
-            f.extractall()
-            toplevel = path.abspath(toplevels[0])
+            self._extractall(f, dest)
+            toplevel = path.abspath(path.join(dest, toplevels[0]))
             assert path.exists(toplevel)
             if not path.isdir(toplevel):
                 # eg: http://pypi.python.org/pypi/DeferArgs/0.4
                 raise SingleFile('archive has a single file: %s', toplevel)
             return toplevel
-        
+
+    def _extractall(self, f, dest):
+        f.extractall(dest)
+
+    def _verify_layout(self, names, dirs, single_toplevel):
+        """Raise what ``extractall_with_single_toplevel`` would about the
+        layout of `names` (`dirs` being the directories among them)
+
+        With `single_toplevel`, several toplevels are an error too.
+        """
+        toplevels = _find_top_level_directories(names, sep='/')
+        if len(toplevels) == 0:
+            raise sh.PackError('archive is empty')
+        elif len(toplevels) > 1:
+            if single_toplevel:
+                raise MultipleTopLevels(
+                    'archive has several toplevels: %s' % sorted(toplevels))
+        else:
+            toplevel = toplevels[0]
+            if toplevel not in dirs and not any(
+                    name.startswith(toplevel + '/') for name in names):
+                raise SingleFile('archive has a single file: %s' % toplevel)
         
 
 class ZippedFile(CompressedFile):
     """A zip file"""
 
+    # already compressed files; ``pack`` stores these as is by default
+    STORED_EXTENSIONS = frozenset([
+        '.zip', '.whl', '.egg', '.jar', '.gz', '.tgz', '.bz2', '.xz', '.zst',
+        '.7z', '.png', '.jpg', '.jpeg', '.gif', '.mp3', '.mp4'])
+
     @staticmethod
     def is_valid(filename):
         return zipfile.is_zipfile(filename)
 
-    def extract(self):
+    def extract(self, dest='.'):
         try:
             f = zipfile.ZipFile(self.filename, 'r')
             try:
                 return self.extractall_with_single_toplevel(
-                    f, f.namelist())
+                    f, f.namelist(), dest)
             except OSError as e:
                 if e.errno == 17:
                     # http://bugs.python.org/issue6510
@@ -87,31 +145,522 @@ class ZippedFile(CompressedFile):
         except (zipfile.BadZipfile, zipfile.LargeZipFile) as e:
             raise sh.PackError(e)
 
+    def verify(self, single_toplevel=False):
+        """Check the CRCs, member names and layout, extracting nothing
+
+        Raise PackError (see ``sh.verify_archive``).
+        """
+        try:
+            with closing(zipfile.ZipFile(self.filename, 'r')) as f:
+                names = f.namelist()
+                for name in names:
+                    _verify_member_path(name)
+                self._verify_layout(
+                    names, set(n.rstrip('/') for n in names if n.endswith('/')),
+                    single_toplevel)
+                bad = f.testzip()
+                if bad is not None:
+                    raise sh.PackError('bad member: %s' % bad)
+        except (zipfile.BadZipfile, zipfile.LargeZipFile, zlib.error) as e:
+            raise sh.PackError(e)
+
+    def mapped(self, verify_crc=False):
+        """Return a ``MappedZipFile`` to read members without copying"""
+        return MappedZipFile(self.filename, verify_crc)
+
+    def list(self):
+        """Return the names of the members, as stored in the archive
+
+        Only the central directory is read.
+        """
+        try:
+            with closing(zipfile.ZipFile(self.filename, 'r')) as f:
+                return f.namelist()
+        except (zipfile.BadZipfile, zipfile.LargeZipFile) as e:
+            raise sh.PackError(e)
+
+    def extract_members(self, patterns, dest='.'):
+        """Extract the members matching `patterns` under `dest`
+
+        Return the extracted paths.
+        """
+        match, _ = _member_matcher(patterns)
+        try:
+            with closing(zipfile.ZipFile(self.filename, 'r')) as f:
+                return [f.extract(info, dest) for info in f.infolist()
+                        if match(info.filename)]
+        except (zipfile.BadZipfile, zipfile.LargeZipFile) as e:
+            raise sh.PackError(e)
+
+    def _extractall(self, f, dest):
+        """Extract the members of `f`, inflating them in `workers` threads
+
+        Each thread reads the archive through its own ZipFile. The directories
+        are created beforehand, so the threads do not race on them.
+        """
+        if self.workers == 1 or sh.futures is None:
+            f.extractall(dest)
+            return
+
+        members = []
+        dirs = set()
+        for info in f.infolist():
+            target = _member_path(dest, info.filename)
+            if info.filename.endswith('/'):
+                dirs.add(target)
+            else:
+                dirs.add(path.dirname(target))
+                members.append(info)
+        for d in sorted(dirs):
+            if not path.isdir(d):
+                os.makedirs(d)
+        # biggest first, so that they do not end up last in a single thread
+        members.sort(key=lambda info: info.compress_size, reverse=True)
+
+        local = threading.local()
+        opened = []
+
+        def extract(info):
+            zf = getattr(local, 'zf', None)
+            if zf is None:
+                zf = local.zf = zipfile.ZipFile(self.filename, 'r')
+                opened.append(zf)
+            zf.extract(info, dest)
+
+        try:
+            with sh.futures.ThreadPoolExecutor(
+                    max_workers=self.workers) as executor:
+                for future in [executor.submit(extract, info)
+                               for info in members]:
+                    future.result()
+        finally:
+            for zf in opened:
+                zf.close()
+
     @classmethod
-    def pack(cls, paths, file):
-        raise NotImplementedError('pack: zip files not supported yet')
+    def pack(cls, paths, file, basedir='.', workers=1, store=None):
+        """Pack `paths` (relative to `basedir`) into the archive `file`
+
+        Files are streamed from disk and deflated, except those with an
+        extension in `store` (defaults to STORED_EXTENSIONS) which are stored
+        as is. ZIP64 extensions are used as needed.
+
+        With `workers` other than 1, members are deflated (into spooled
+        temporary files) in a thread pool, and written to the archive in
+        order as they are ready.
+        """
+        store = cls.STORED_EXTENSIONS if store is None else frozenset(store)
+        members = []
+        for pth in paths:
+            fullpath = path.join(basedir, pth)
+            assert path.exists(fullpath), '"%s" does not exist' % fullpath
+            members.extend(_walk_members(fullpath, pth))
+
+        zf = zipfile.ZipFile(file, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        try:
+            if workers == 1 or sh.futures is None:
+                for fullpath, arcname in members:
+                    zf.write(fullpath, arcname, None if path.isdir(fullpath)
+                             else _zip_compress_type(arcname, store))
+                return
+
+            # bound the number of members compressed ahead of the writer
+            window = 2 * workers if workers else 64
+            with sh.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                pending = collections.deque()
+                for fullpath, arcname in members:
+                    pending.append((fullpath, executor.submit(
+                        _compress_member, fullpath, arcname, store)))
+                    if len(pending) >= window:
+                        fullpath, future = pending.popleft()
+                        _write_member(zf, fullpath, *future.result())
+                while pending:
+                    fullpath, future = pending.popleft()
+                    _write_member(zf, fullpath, *future.result())
+        finally:
+            zf.close()
     
 
+class MappedZipFile(object):
+    """Read-only access to the members of a memory mapped zip file
+
+    ``read`` returns a memoryview of the archive itself for stored members
+    (no copying at all), and the inflated data for deflated ones;
+    ``iter_chunks`` streams either. With `verify_crc`, the CRC of each member
+    is checked the first time it is read in full (PackError if it does not
+    match).
+
+    The memoryviews must be released (or dropped) before ``close``.
+    """
+
+    def __init__(self, filename, verify_crc=False):
+        self.filename = filename
+        self.verify_crc = verify_crc
+        self._verified = set()
+        try:
+            with closing(zipfile.ZipFile(filename, 'r')) as f:
+                self._infos = dict((info.filename, info)
+                                   for info in f.infolist())
+        except (zipfile.BadZipfile, zipfile.LargeZipFile) as e:
+            raise sh.PackError(e)
+        self._file = open(filename, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+
+    def namelist(self):
+        return list(self._infos)
+
+    def read(self, name):
+        """Return the data of member `name` (a memoryview if it is stored)"""
+        info, data = self._member(name)
+        if info.compress_type == zipfile.ZIP_STORED:
+            if self._needs_check(info):
+                self._check(info, zlib.crc32(data))
+            return data
+        return b''.join(self.iter_chunks(name))
+
+    def iter_chunks(self, name, chunk_size=_CHUNK_SIZE):
+        """Yield the data of member `name` in chunks of about `chunk_size`"""
+        info, data = self._member(name)
+        check = self._needs_check(info)
+        crc = 0
+        if info.compress_type == zipfile.ZIP_STORED:
+            for start in range(0, len(data), chunk_size):
+                chunk = data[start:start+chunk_size]
+                if check:
+                    crc = zlib.crc32(chunk, crc)
+                yield chunk
+        else:
+            inflater = zlib.decompressobj(-15)
+            for start in range(0, len(data), chunk_size):
+                compressed = data[start:start+chunk_size]
+                while compressed:
+                    chunk = inflater.decompress(compressed, chunk_size)
+                    compressed = inflater.unconsumed_tail
+                    if check:
+                        crc = zlib.crc32(chunk, crc)
+                    yield chunk
+            chunk = inflater.flush()
+            if check:
+                crc = zlib.crc32(chunk, crc)
+            yield chunk
+        if check:
+            self._check(info, crc)
+
+    def _member(self, name):
+        """Return (ZipInfo, compressed data) for member `name`"""
+        info = self._infos[name]
+        if info.flag_bits & 0x1:
+            raise sh.PackError('encrypted member: %s' % name)
+        if info.compress_type not in (zipfile.ZIP_STORED,
+                                      zipfile.ZIP_DEFLATED):
+            raise sh.PackError('unsupported compression ({0}): {1}'.format(
+                info.compress_type, name))
+        offset = info.header_offset
+        header = self._map[offset:offset+30]
+        if header[:4] != b'PK\x03\x04':
+            raise sh.PackError('bad local file header: %s' % name)
+        name_size, extra_size = struct.unpack('<HH', header[26:30])
+        start = offset + 30 + name_size + extra_size
+        return info, self._view[start:start+info.compress_size]
+
+    def _needs_check(self, info):
+        """Return True if the CRC of `info` is to be computed and checked"""
+        return self.verify_crc and info.filename not in self._verified
+
+    def _check(self, info, crc):
+        if crc & 0xffffffff != info.CRC:
+            raise sh.PackError('bad CRC-32 for member: %s' % info.filename)
+        self._verified.add(info.filename)
+
+    def close(self):
+        self._view.release()
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _PlainCodec(object):
+    """Uncompressed data"""
+
+    compress = None  # not worth doing in parallel
+
+    @staticmethod
+    def open(filename):
+        return open(filename, 'rb')
+
+
+class _GzipCodec(object):
+    """gzip, compressed in blocks the way pigz does it
+
+    Each block is raw deflate data, primed with the end of the previous
+    block as dictionary (Python 3.3+) and ending on a byte boundary
+    (Z_SYNC_FLUSH); so the blocks, concatenated, make a single gzip member.
+    """
+
+    block_size = 1024*1024
+
+    def __init__(self):
+        self.crc = 0
+        self.size = 0
+
+    @staticmethod
+    def open(filename):
+        return gzip.GzipFile(filename, 'rb')
+
+    def header(self):
+        # no name, maximum compression, unknown OS
+        return (b'\x1f\x8b\x08\x00' + struct.pack('<I', int(time.time())) +
+                b'\x02\xff')
+
+    def update(self, block):
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+
+    @staticmethod
+    def compress(block, previous, final):
+        if previous and _HAS_ZDICT:
+            compressor = zlib.compressobj(
+                9, zlib.DEFLATED, -15, zlib.DEF_MEM_LEVEL,
+                zlib.Z_DEFAULT_STRATEGY, previous[-32768:])
+        else:
+            compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+        return compressor.compress(block) + compressor.flush(
+            zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+    def trailer(self):
+        return struct.pack('<II', self.crc & 0xffffffff,
+                           self.size & 0xffffffff)
+
+
+class _Bzip2Codec(object):
+    """bzip2, compressed in blocks the way pbzip2 does it
+
+    Each block is an independent bzip2 stream. Python 2 only reads the first
+    stream of such files.
+    """
+
+    block_size = 900*1000  # that of bzip2 -9
+
+    @staticmethod
+    def open(filename):
+        return bz2.BZ2File(filename, 'rb')
+
+    def header(self):
+        return b''
+
+    def update(self, block):
+        pass
+
+    @staticmethod
+    def compress(block, previous, final):
+        return bz2.compress(block, 9)
+
+    def trailer(self):
+        return b''
+
+
+class _XzCodec(object):
+    """xz, compressed in blocks; each block is an independent xz stream"""
+
+    block_size = 4*1024*1024
+
+    @staticmethod
+    def open(filename):
+        _require(lzma, 'lzma', 'xz')
+        return lzma.LZMAFile(filename, 'rb')
+
+    def header(self):
+        return b''
+
+    def update(self, block):
+        pass
+
+    @staticmethod
+    def compress(block, previous, final):
+        return lzma.compress(block)
+
+    def trailer(self):
+        return b''
+
+
+class _ZstdCodec(object):
+    """zstd; see ZstdTarredFile.pack for compression"""
+
+    compress = None
+
+    @staticmethod
+    def open(filename):
+        _require(zstandard, 'zstandard', 'zstd')
+        return zstandard.ZstdDecompressor().stream_reader(
+            open(filename, 'rb'), read_across_frames=True)
+
+
+class _ParallelCompressor(object):
+    """Write-only file object compressing its data with `codec` in blocks
+
+    The blocks are compressed by a pool of `workers` threads (zlib and bz2
+    release the GIL), and written to `fileobj` in order.
+    """
+
+    def __init__(self, fileobj, codec, workers):
+        self.fileobj = fileobj
+        self.codec = codec
+        self.executor = sh.futures.ThreadPoolExecutor(max_workers=workers)
+        # bound the number of blocks held in memory
+        self.window = 2 * workers if workers else 64
+        self.pending = collections.deque()
+        self.buffer = []
+        self.buffered = 0
+        self.previous = b''
+        self.fileobj.write(self.codec.header())
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.codec.block_size:
+            self._submit(final=False)
+
+    def _submit(self, final):
+        block = b''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        self.codec.update(block)
+        self.pending.append(self.executor.submit(
+            self.codec.compress, block, self.previous, final))
+        self.previous = block
+        while self.pending and (final or len(self.pending) >= self.window):
+            self.fileobj.write(self.pending.popleft().result())
+
+    def close(self):
+        try:
+            self._submit(final=True)
+            self.fileobj.write(self.codec.trailer())
+        finally:
+            self.executor.shutdown()
+
+
+class _Decompressed(object):
+    """Read-only file object over a GzipFile/BZ2File, for tarfile
+
+    Decompression errors (which, unlike I/O errors, have no errno) are raised
+    as tarfile.ReadError, as tarfile's own decompression does.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        try:
+            return self.fileobj.read(size)
+        except _DECOMPRESSION_ERRORS as e:
+            raise tarfile.ReadError(str(e))
+        except (IOError, OSError) as e:
+            if e.errno is not None:
+                raise
+            raise tarfile.ReadError(str(e))
+
+
 class TarredFile(CompressedFile):
     """A tar.gz/bz2 file"""
-    
+
+    format = None  # as returned by ``sniff``
+    _codec = None
+
     @classmethod
     def is_valid(cls, filename):
+        if sniff(filename) != cls.format:
+            return False
         try:
-            with closing(tarfile.open(filename, cls._get_mode())) as f:
+            # only the first member header is decompressed
+            with closing(cls._codec.open(filename)) as fileobj:
+                tarfile.open(fileobj=_Decompressed(fileobj), mode='r|').close()
                 return True
         except tarfile.TarError:
             return False
 
-    def extract(self):
+    def extract(self, dest='.'):
+        with self._open_stream() as f:
+            return self._extract_stream(f, dest)
+
+    def list(self):
+        """Return the names of the members, as stored in the archive"""
+        with self._open_stream() as f:
+            return [tarinfo.name for tarinfo in f]
+
+    def extract_members(self, patterns, dest='.'):
+        """Extract the members matching `patterns` under `dest`
+
+        The archive is scanned (and decompressed) only as far as needed when
+        `patterns` are all literal names. Return the extracted paths.
+
+        As the archive is read as a stream, a hard link can only be extracted
+        along with the member it links to, which must match `patterns` too
+        (PackError otherwise).
+        """
+        match, literals = _member_matcher(patterns)
+        extracted = []
+        names = set()
+        with self._open_stream() as f:
+            for tarinfo in f:
+                if not match(tarinfo.name):
+                    continue
+                if tarinfo.islnk() and tarinfo.linkname not in names:
+                    # tarfile would have to read it again, seeking backwards
+                    raise sh.PackError(
+                        'hard link to unextracted member: {0} -> {1}'.format(
+                            tarinfo.name, tarinfo.linkname))
+                _ensure_read_write_access(tarinfo)
+                f.extract(tarinfo, dest)
+                names.add(tarinfo.name)
+                extracted.append(path.join(dest, tarinfo.name))
+                if literals is not None:
+                    literals.discard(tarinfo.name)
+                    if not literals:
+                        break
+        return extracted
+
+    def verify(self, single_toplevel=False):
+        """Check the checksums, member headers, names and layout, extracting
+        nothing
+
+        Raise PackError (see ``sh.verify_archive``).
+        """
+        names = []
+        dirs = set()
+        with self._open_stream() as f:
+            # member data is decompressed (and checked) as tarfile skips it
+            for tarinfo in f:
+                _verify_member_path(tarinfo.name)
+                if tarinfo.issym():
+                    _verify_member_path(tarinfo.linkname, tarinfo.name)
+                elif tarinfo.islnk():
+                    _verify_member_path(tarinfo.linkname)
+                names.append(tarinfo.name)
+                if tarinfo.isdir():
+                    dirs.add(tarinfo.name)
+            # the end of the compressed stream holds its checksum
+            while f.fileobj.read(_CHUNK_SIZE):
+                pass
+        self._verify_layout(names, dirs, single_toplevel)
+
+    @contextmanager
+    def _open_stream(self):
+        """Open the archive as a tarfile to be read once, in order"""
         try:
-            f = tarfile.open(self.filename, self._get_mode())
-            try:
-                _ensure_read_write_access(f)
-                return self.extractall_with_single_toplevel(
-                    f, f.getnames())
-            finally:
-                f.close()
+            with closing(self._codec.open(self.filename)) as fileobj:
+                # not 'r|gz' or 'r|bz2': tarfile's own stream decompression
+                # stops at the end of the first gzip member/bzip2 stream
+                f = tarfile.open(fileobj=_Decompressed(fileobj), mode='r|')
+                try:
+                    yield f
+                finally:
+                    f.close()
         except tarfile.TarError as e:
             raise sh.PackError(e)
         except IOError as e:
@@ -129,16 +678,94 @@ class TarredFile(CompressedFile):
                 if isinstance(e, WindowsError) and e.winerror == 123:
                     raise sh.PackError(e)
             raise
+
+    def _extract_stream(self, f, dest):
+        """Extract the streamed tarfile `f` in a single pass
+
+        Same as ``extractall_with_single_toplevel``, except that the toplevel
+        layout is worked out member by member: when a second toplevel entry
+        shows up, whatever was extracted so far is moved into the new toplevel
+        directory named after the archive.
+        """
+        toplevels = []
+        target = dest
+        directories = []
+        for tarinfo in f:
+            _ensure_read_write_access(tarinfo)
+            toplevel = tarinfo.name.split('/', 1)[0]
+            if toplevel not in toplevels:
+                toplevels.append(toplevel)
+                if len(toplevels) == 2:
+                    target = path.join(dest, self.basename)
+                    first = path.join(dest, toplevels[0])
+                    if path.lexists(first):
+                        # moved aside first, as it may have the name of
+                        # `target` (eg: foo-1.0/ in foo-1.0.tar.gz)
+                        moved = tempfile.mkdtemp(prefix='.tmp-', dir=dest)
+                        os.rename(first, path.join(moved, toplevels[0]))
+                        os.mkdir(target)
+                        os.rename(path.join(moved, toplevels[0]),
+                                  path.join(target, toplevels[0]))
+                        os.rmdir(moved)
+                    else:
+                        os.mkdir(target)
+            if tarinfo.isdir():
+                directories.append(tarinfo)
+            f.extract(tarinfo, target)
+
+        # like extractall, restore directory mtimes once their contents are
+        # in place (deepest first)
+        directories.sort(key=lambda tarinfo: tarinfo.name, reverse=True)
+        for tarinfo in directories:
+            dirpath = path.join(target, tarinfo.name)
+            if path.isdir(dirpath):
+                os.utime(dirpath, (tarinfo.mtime, tarinfo.mtime))
+
+        if len(toplevels) == 0:
+            raise sh.PackError('archive is empty')
+        elif len(toplevels) > 1:
+            return path.abspath(target)
+        else:
+            toplevel = path.abspath(path.join(dest, toplevels[0]))
+            assert path.exists(toplevel)
+            if not path.isdir(toplevel):
+                # eg: http://pypi.python.org/pypi/DeferArgs/0.4
+                raise SingleFile('archive has a single file: %s', toplevel)
+            return toplevel
             
     @classmethod
-    def pack(cls, paths, file):
-        f = tarfile.open(file, cls._get_mode('w'))
-        try:
-            for pth in paths:
-                assert path.exists(pth), '"%s" does not exist' % path
-                f.add(pth)
-        finally:
-            f.close()
+    def pack(cls, paths, file, basedir='.', workers=1):
+        """Pack `paths` (relative to `basedir`) into the archive `file`
+
+        With `workers` other than 1, the tar stream is compressed in blocks
+        by a pool of `workers` threads (None for as many as
+        ``concurrent.futures`` sees fit), like pigz and pbzip2 do.
+        """
+        if workers == 1 or sh.futures is None or cls._codec.compress is None:
+            f = tarfile.open(file, cls._get_mode('w'))
+            try:
+                cls._add(f, paths, basedir)
+            finally:
+                f.close()
+            return
+
+        with open(file, 'wb') as fileobj:
+            writer = _ParallelCompressor(fileobj, cls._codec(), workers)
+            try:
+                f = tarfile.open(fileobj=writer, mode='w|')
+                try:
+                    cls._add(f, paths, basedir)
+                finally:
+                    f.close()
+            finally:
+                writer.close()
+
+    @staticmethod
+    def _add(f, paths, basedir):
+        for pth in paths:
+            fullpath = path.join(basedir, pth)
+            assert path.exists(fullpath), '"%s" does not exist' % fullpath
+            f.add(fullpath, arcname=pth)
 
     def _get_mode(self):
         """Return the mode for this tarfile"""
@@ -148,6 +775,21 @@ class TarredFile(CompressedFile):
 class GzipTarredFile(TarredFile):
     """A tar.gz2 file"""
 
+    format = 'gzip'
+    _codec = _GzipCodec
+
+    def index(self, spacing=None):
+        """Return the ``GzipIndex`` of this file, for random access reads
+
+        The index is stored next to the file, and (re)built if it is missing
+        or out of date; see ``applib._gzindex``.
+        """
+        from applib._gzindex import GzipIndex
+        index = GzipIndex(self.filename)
+        if not index.is_current():
+            index.build(spacing)
+        return index
+
     @staticmethod
     def _get_mode(mode='r'):
         assert mode in ['r', 'w']
@@ -157,16 +799,112 @@ class GzipTarredFile(TarredFile):
 class Bzip2TarredFile(TarredFile):
     """A tar.gz2 file"""
 
+    format = 'bzip2'
+    _codec = _Bzip2Codec
+
     @staticmethod
     def _get_mode(mode='r'):
         assert mode in ['r', 'w']
         return mode + ':bz2'
 
 
+class XzTarredFile(TarredFile):
+    """A tar.xz file"""
+
+    format = 'xz'
+    _codec = _XzCodec
+
+    @staticmethod
+    def _get_mode(mode='r'):
+        assert mode in ['r', 'w']
+        _require(lzma, 'lzma', 'xz')
+        return mode + ':xz'
+
+
+class ZstdTarredFile(TarredFile):
+    """A tar.zst file (requires the 'zstandard' package)"""
+
+    format = 'zstd'
+    _codec = _ZstdCodec
+
+    @classmethod
+    def pack(cls, paths, file, basedir='.', workers=1):
+        """Pack `paths` (relative to `basedir`) into the archive `file`
+
+        zstd compresses in its own `workers` threads (None for one per core).
+        """
+        _require(zstandard, 'zstandard', 'zstd')
+        threads = 0 if workers == 1 else (workers or -1)
+        # with a content checksum (as the zstd CLI does), so that corrupt
+        # data is detected
+        compressor = zstandard.ZstdCompressor(threads=threads,
+                                              write_checksum=True)
+        with open(file, 'wb') as fileobj:
+            with compressor.stream_writer(fileobj) as writer:
+                f = tarfile.open(fileobj=writer, mode='w|')
+                try:
+                    cls._add(f, paths, basedir)
+                finally:
+                    f.close()
+
+
+class PlainTarredFile(TarredFile):
+    """An uncompressed tar file"""
+
+    format = 'tar'
+    _codec = _PlainCodec
+
+    @staticmethod
+    def _get_mode(mode='r'):
+        assert mode in ['r', 'w']
+        return mode + ':'
+
+
 implementors = dict(
     zip = ZippedFile,
     tgz = GzipTarredFile,
-    bz2 = Bzip2TarredFile)
+    bz2 = Bzip2TarredFile,
+    txz = XzTarredFile,
+    tzst = ZstdTarredFile,
+    tar = PlainTarredFile)
+
+# format (as returned by ``sniff``) -> key in ``implementors``
+formats = dict(
+    gzip = 'tgz',
+    bzip2 = 'bz2',
+    xz = 'txz',
+    zstd = 'tzst',
+    zip = 'zip',
+    tar = 'tar')
+
+# (offset, magic bytes, format)
+_SIGNATURES = [
+    (0, b'\x1f\x8b', 'gzip'),
+    (0, b'BZh', 'bzip2'),
+    (0, b'\xfd7zXZ\x00', 'xz'),
+    (0, b'\x28\xb5\x2f\xfd', 'zstd'),
+    (0, b'PK\x03\x04', 'zip'),
+    (0, b'PK\x05\x06', 'zip'),  # empty zip file
+    (257, b'ustar', 'tar'),
+]
+
+
+def sniff(filename):
+    """Detect the format of the archive `filename` from its magic bytes
+
+    Return one of 'gzip', 'bzip2', 'xz', 'zstd', 'zip' or 'tar'; or None if
+    the format is not recognized. Only the first block of the file is read,
+    except for zip files with leading data (eg: self-extracting archives)
+    which are detected from their central directory.
+    """
+    with open(filename, 'rb') as f:
+        header = f.read(512)
+    for offset, magic, format in _SIGNATURES:
+        if header[offset:offset+len(magic)] == magic:
+            return format
+    if zipfile.is_zipfile(filename):
+        return 'zip'
+    return None
 
 
 class MultipleTopLevels(sh.PackError):
@@ -176,9 +914,9 @@ class SingleFile(sh.PackError):
     contain one directory
     """
     
-def _ensure_read_write_access(tarfileobj):
-    """Ensure that the given tarfile will be readable and writable by the
-    user (the client program using this API) after extraction.
+def _ensure_read_write_access(tarinfo):
+    """Ensure that the given tarfile member will be readable and writable by
+    the user (the client program using this API) after extraction.
 
     Some tarballs have u-x set on directories or u-w on files. We reset such
     perms here.. so that the extracted files remain accessible for reading
@@ -186,13 +924,159 @@ def _ensure_read_write_access(tarfileobj):
 
     See also: http://bugs.python.org/issue6196
     """
-    dir_perm = tarfile.TUREAD | tarfile.TUWRITE | tarfile.TUEXEC
-    file_perm = tarfile.TUREAD | tarfile.TUWRITE
+    dir_perm = stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR
+    file_perm = stat.S_IRUSR | stat.S_IWUSR
 
-    for tarinfo in tarfileobj.getmembers():
-        tarinfo.mode |= (dir_perm if tarinfo.isdir() else file_perm)
+    tarinfo.mode |= (dir_perm if tarinfo.isdir() else file_perm)
         
 
+def _member_matcher(patterns):
+    """Return (match, literals) for the member name `patterns`
+
+    `match` is as returned by ``sh._compile_patterns``; `literals` is the set
+    of names to look for, or None if some of the patterns are globs.
+    """
+    if isinstance(patterns, six.string_types):
+        patterns = [patterns]
+    literals = set(patterns)
+    if any(c in pattern for pattern in patterns for c in '*?['):
+        literals = None
+    return sh._compile_patterns(patterns), literals
+
+
+def _verify_member_path(name, link_from=None):
+    """Raise PackError if the member `name` would be extracted outside of
+    the destination directory
+
+    For the target of a symbolic link, `link_from` is the link's name.
+    """
+    parts = name.replace('\\', '/').split('/')
+    if link_from is not None:
+        parts = link_from.split('/')[:-1] + parts
+    depth = 0
+    for part in parts:
+        if part == '..':
+            depth -= 1
+        elif part not in ('', '.'):
+            depth += 1
+        if depth < 0:
+            break
+    if name.startswith(('/', '\\')) or path.splitdrive(name)[0] or \
+            name[1:2] == ':' or depth < 0:
+        raise sh.PackError('unsafe member path: %s' % (
+            name if link_from is None else '{0} -> {1}'.format(link_from, name)))
+
+
+def _member_path(dest, name):
+    """Return where ``ZipFile.extract`` puts the member `name` under `dest`"""
+    name = path.splitdrive(name.replace('/', os.sep))[1]
+    parts = [x for x in name.split(os.sep)
+             if x not in ('', os.curdir, os.pardir)]
+    return path.join(dest, *parts)
+
+
+_DECOMPRESSION_ERRORS = (EOFError, zlib.error)
+if lzma is not None:
+    _DECOMPRESSION_ERRORS += (lzma.LZMAError,)
+if zstandard is not None:
+    _DECOMPRESSION_ERRORS += (zstandard.ZstdError,)
+
+
+def _require(module, name, format):
+    """Raise PackError if the optional `module` (named `name`) is missing"""
+    if module is None:
+        raise sh.PackError(
+            '{0} archives require the {1!r} module'.format(format, name))
+
+
+def _walk_members(fullpath, arcname):
+    """Yield (path, archive name) for `fullpath` and everything under it"""
+    yield fullpath, arcname
+    if path.isdir(fullpath) and not path.islink(fullpath):
+        for name in sorted(os.listdir(fullpath)):
+            for member in _walk_members(path.join(fullpath, name),
+                                        path.join(arcname, name)):
+                yield member
+
+
+def _zip_compress_type(arcname, store):
+    if path.splitext(arcname)[1].lower() in store:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def _compress_member(fullpath, arcname, store):
+    """Return (ZipInfo, deflated data) for the file `fullpath`
+
+    The data is a spooled temporary file, or None for directories and stored
+    files (which ``_write_member`` copies from disk).
+    """
+    st = os.stat(fullpath)
+    isdir = stat.S_ISDIR(st.st_mode)
+    # zip timestamps cannot go before 1980
+    date_time = max(time.localtime(st.st_mtime)[0:6], (1980, 1, 1, 0, 0, 0))
+    zinfo = zipfile.ZipInfo(arcname + ('/' if isdir else ''), date_time)
+    zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+    zinfo.compress_type = zipfile.ZIP_STORED
+    zinfo.file_size = zinfo.compress_size = zinfo.CRC = 0
+    if isdir:
+        zinfo.external_attr |= 0x10  # MS-DOS directory flag
+        return zinfo, None
+
+    zinfo.compress_type = _zip_compress_type(arcname, store)
+    data = compressor = None
+    if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+        data = SpooledTemporaryFile(max_size=_SPOOL_SIZE)
+        compressor = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    crc = 0
+    with open(fullpath, 'rb') as f:
+        while True:
+            chunk = f.read(_CHUNK_SIZE)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            zinfo.file_size += len(chunk)
+            if compressor:
+                data.write(compressor.compress(chunk))
+    zinfo.CRC = crc & 0xffffffff
+    if compressor:
+        data.write(compressor.flush())
+        zinfo.compress_size = data.tell()
+        data.seek(0)
+    else:
+        zinfo.compress_size = zinfo.file_size
+    return zinfo, data
+
+
+def _write_member(zf, fullpath, zinfo, data):
+    """Append a member prepared by ``_compress_member`` to `zf`
+
+    ZipFile has no public API for writing already compressed data; so this
+    does what ``ZipFile.write`` does, with the local header written upfront.
+    """
+    zf._writecheck(zinfo)
+    zinfo.header_offset = zf.fp.tell()
+    zf.fp.write(zinfo.FileHeader())
+    if data is not None:
+        with closing(data):
+            shutil.copyfileobj(data, zf.fp, _CHUNK_SIZE)
+    elif zinfo.file_size:
+        with open(fullpath, 'rb') as f:
+            left = zinfo.file_size
+            while left:
+                chunk = f.read(min(left, _CHUNK_SIZE))
+                if not chunk:
+                    raise sh.PackError('file changed while packing: %s' %
+                                       fullpath)
+                zf.fp.write(chunk)
+                left -= len(chunk)
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
+    zf._didModify = True
+    zf.start_dir = zf.fp.tell()
+
+
 def _find_top_level_directories(fileslist, sep):
     """Find the distinct first components in the fileslist"""
     toplevels = set()
@@ -209,6 +1093,11 @@ def _archive_basename(filename):
         '.tgz',
         '.tar.bz2',
         '.bz2',
+        '.tar.xz',
+        '.txz',
+        '.tar.zst',
+        '.tzst',
+        '.tar',
         '.zip')
 
     filename = path.basename(filename)
@@ -0,0 +1,239 @@
+# Copyright (c) 2010 ActiveState Software Inc. All rights reserved.
+
+"""Content-addressed cache of extracted archives for ``sh.unpack_archive``
+
+Each archive is extracted once into an entry named after the SHA-256 of its
+contents; unpacking the same bytes again copies the cached tree out of the
+entry (with reflinks or hardlinks where possible) instead of decompressing.
+
+Entries are extracted in a temporary directory and renamed into place, so
+that processes sharing the cache never see a partial entry. The least
+recently used entries are evicted once the cache grows beyond `max_size`;
+entries being copied out of are locked (with flock; not on Windows), and
+skipped.
+"""
+
+import os
+from os import path
+import time
+import json
+import errno
+import hashlib
+import binascii
+import tempfile
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows
+
+__all__ = ['ExtractionCache']
+
+
+class ExtractionCache(object):
+    """Cache of the trees extracted from archives, stored in `cache_dir`
+
+    - max_size: total size (in bytes) of the extracted files beyond which
+                the least recently used entries are evicted; None for no
+                limit
+    - mode:     how cached trees are copied out; see ``sh.cp``. With
+                'hardlink' (and 'auto', where reflinks are not supported)
+                the unpacked files are the cached ones, and modifying them
+                in place corrupts the cache
+    """
+
+    # temporary directories left behind (eg: by a killed process) for this
+    # long (in seconds) are removed on eviction
+    STALE_AGE = 3600
+
+    def __init__(self, cache_dir, max_size=None, mode='reflink-or-copy'):
+        from applib import sh  # which imports this module
+
+        assert mode in sh._COPY_MODES, 'invalid mode: %s' % mode
+        self.root = cache_dir
+        self.max_size = max_size
+        self.mode = mode
+        if not path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    @classmethod
+    def for_application(cls, app, max_size=None, mode='reflink-or-copy'):
+        """Return the extraction cache in the cache directory of `app`
+
+        `app` is an applib.base.Application.
+        """
+        return cls(path.join(app.locations.user_cache_dir, 'extractcache'),
+                   max_size, mode)
+
+    def unpack(self, filename, dest, workers=1):
+        """Same as ``sh.unpack_archive``, but through the cache"""
+        digest = _sha256(filename)
+        entry = path.join(self.root, digest)
+        # held while copying out, so that the entry is not evicted meanwhile
+        lock = _lock(entry)
+        while lock is None:
+            self._populate(filename, entry, workers)
+            lock = _lock(entry)  # None if it was evicted already
+        try:
+            info = json.load(lock)
+            os.utime(entry, None)  # most recently used
+            toplevel = self._copy_out(filename, entry, info, dest, workers)
+        finally:
+            lock.close()
+        return toplevel, info['filetype']
+
+    def _copy_out(self, filename, entry, info, dest, workers):
+        """Copy the tree of the (locked) cache `entry` to `dest`"""
+        from applib import sh, _compression
+
+        # the directory wrapping several toplevels is named after the
+        # archive, which may differ from the one the entry was made from
+        if info['wrapped']:
+            toplevel = _compression._archive_basename(filename)
+        else:
+            toplevel = info['toplevel']
+        toplevel = path.join(dest, toplevel)
+        sh.cp(path.join(entry, 'tree', info['toplevel']), toplevel,
+              workers=workers, mode=self.mode)
+        return path.abspath(toplevel)
+
+    def _lookup(self, entry):
+        """Return the info of the cache `entry`, or None if it is missing"""
+        try:
+            with open(path.join(entry, 'info.json')) as f:
+                return json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    def _populate(self, filename, entry, workers):
+        """Extract `filename` into the cache `entry`"""
+        from applib import sh
+
+        tmp = tempfile.mkdtemp(prefix='tmp-', dir=self.root)
+        try:
+            tree = path.join(tmp, 'tree')
+            os.mkdir(tree)
+            filetype, implementor = sh._archive_implementor(filename)
+            archive = implementor(filename, workers)
+            # the hash of the archive cannot be the name of one of its members
+            archive.basename = path.basename(entry)
+            toplevel = path.relpath(archive.extract(tree), tree)
+            info = dict(toplevel=toplevel,
+                        wrapped=toplevel == archive.basename,
+                        filetype=filetype,
+                        size=_tree_size(tree))
+            with open(path.join(tmp, 'info.json'), 'w') as f:
+                json.dump(info, f)
+            try:
+                os.rename(tmp, entry)
+            except OSError:
+                if not path.isdir(entry):
+                    raise
+                # another process got there first; theirs is as good
+        finally:
+            if path.exists(tmp):
+                sh.rm(tmp)
+        self._evict(keep=entry)
+
+    def _evict(self, keep):
+        """Remove the least recently used entries (but `keep`) beyond
+        `max_size`"""
+        from applib import sh
+
+        entries = []
+        for name in os.listdir(self.root):
+            entry = path.join(self.root, name)
+            try:
+                mtime = os.stat(entry).st_mtime
+                if name.startswith('tmp-'):
+                    if mtime < time.time() - self.STALE_AGE:
+                        sh.rm(entry)
+                    continue
+                info = self._lookup(entry)
+            except (OSError, IOError):
+                continue  # evicted by another process
+            if info is not None:
+                entries.append((mtime, info['size'], entry))
+
+        if self.max_size is None:
+            return
+        total = sum(size for (_, size, _) in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            if entry == keep:
+                continue
+            lock = _lock(entry, exclusive=True)
+            if lock is None:
+                continue  # in use, or evicted by another process
+            # renamed away first, so that no one finds it half removed
+            trash = path.join(self.root, 'tmp-{0}'.format(
+                binascii.hexlify(os.urandom(8)).decode('ascii')))
+            try:
+                os.rename(entry, trash)
+            finally:
+                lock.close()
+            sh.rm(trash)
+            total -= size
+
+    def __str__(self):
+        return '{0.__class__.__name__}<{0.root}>'.format(self)
+
+
+def _lock(entry, exclusive=False):
+    """Open and lock the info file of the cache `entry`
+
+    Shared locks are held while copying out of the entry; an exclusive one is
+    taken (without waiting) to evict it. Return the open file, which is to be
+    closed to release the lock; or None if the entry does not exist (anymore)
+    or, if `exclusive`, is in use.
+    """
+    info_path = path.join(entry, 'info.json')
+    try:
+        f = open(info_path)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    if fcntl is None:
+        return f
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB if exclusive
+                    else fcntl.LOCK_SH)
+    except IOError as e:
+        f.close()
+        if exclusive and e.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+    # the entry may have been evicted while waiting for the lock
+    try:
+        if path.samestat(os.fstat(f.fileno()), os.stat(info_path)):
+            return f
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            f.close()
+            raise
+    f.close()
+    return None
+
+
+def _sha256(filename):
+    """Return the SHA-256 hex digest of the contents of `filename`"""
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(1024*1024)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _tree_size(pth):
+    """Return the total size of the files under `pth`"""
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(pth):
+        for name in filenames:
+            size += os.lstat(path.join(dirpath, name)).st_size
+    return size
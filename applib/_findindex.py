@@ -0,0 +1,171 @@
+# Copyright (c) 2010 ActiveState Software Inc. All rights reserved.
+
+"""Persistent index of a directory tree for repeated ``sh.find`` queries
+
+The index is a SQLite database holding the listing of every directory under
+the root, along with the directory's mtime and inode. Refreshing it only
+re-lists the directories whose mtime (or inode) changed since; so for large,
+slowly changing trees a refresh costs one stat per directory rather than a
+full walk.
+"""
+
+import os
+from os import path
+import time
+import hashlib
+import sqlite3
+
+import six
+
+__all__ = ['FileIndex']
+
+
+class FileIndex(object):
+    """Index of the files and directories under `root`
+
+    The database is stored in `cache_dir`, under a name derived from the
+    absolute path of `root`; so an index created for the same root is reused
+    across processes.
+    """
+
+    # directories modified this recently (in seconds) when refreshing are
+    # listed again on the next refresh; their mtime may not reflect changes
+    # made right after we listed them (eg: on filesystems with 1s resolution)
+    RACY_INTERVAL = 2
+
+    def __init__(self, root, cache_dir):
+        self.root = root
+        abs_root = path.abspath(root)
+        if not path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.path = path.join(cache_dir, 'findindex-{0}.sqlite'.format(
+            hashlib.sha1(abs_root.encode('utf-8')).hexdigest()[:16]))
+
+        self.db = sqlite3.connect(self.path)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS dirs ('
+                            'path TEXT PRIMARY KEY, mtime INTEGER, '
+                            'ino INTEGER)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                            'dir TEXT, name TEXT, type TEXT, is_dir INTEGER, '
+                            'PRIMARY KEY (dir, name))')
+
+    @classmethod
+    def for_application(cls, app, root):
+        """Return the index of `root` in the cache directory of `app`
+
+        `app` is an applib.base.Application.
+        """
+        return cls(root, app.locations.user_cache_dir)
+
+    def refresh(self):
+        """Bring the index up to date with the filesystem"""
+        known = dict((p, (mtime, ino)) for (p, mtime, ino) in
+                     self.db.execute('SELECT path, mtime, ino FROM dirs'))
+        known_subdirs = {}
+        for rel, name in self.db.execute(
+                'SELECT dir, name FROM entries WHERE is_dir AND type != ?',
+                ('l',)):
+            known_subdirs.setdefault(rel, []).append(name)
+        seen = set()
+        racy_after = time.time() - self.RACY_INTERVAL
+
+        with self.db:
+            pending = ['']
+            while pending:
+                rel = pending.pop()
+                full = path.join(self.root, rel)
+                try:
+                    st = os.stat(full)
+                except OSError:
+                    continue  # removed; will be purged below
+                seen.add(rel)
+
+                mtime = _mtime_ns(st)
+                if known.get(rel) == (mtime, st.st_ino):
+                    subdirs = known_subdirs.get(rel, [])
+                else:
+                    subdirs = self._relist(rel, full)
+                    if st.st_mtime > racy_after:
+                        mtime = -1  # do not trust it; see RACY_INTERVAL
+                    self.db.execute(
+                        'INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)',
+                        (rel, mtime, st.st_ino))
+                pending.extend(path.join(rel, name) for name in subdirs)
+
+            for rel in set(known) - seen:
+                self.db.execute('DELETE FROM dirs WHERE path = ?', (rel,))
+                self.db.execute('DELETE FROM entries WHERE dir = ?', (rel,))
+
+    def _relist(self, rel, full):
+        """Replace the entries of directory `rel`; return its subdirectories"""
+        from applib import sh  # which imports this module
+
+        rows = []
+        subdirs = []
+        try:
+            entries = list(sh.scandir(full))
+        except OSError:
+            entries = []  # like os.walk, ignore unlistable directories
+        for entry in entries:
+            is_dir = entry.is_dir()
+            entry_type = sh._entry_type(entry) or ''
+            rows.append((rel, entry.name, entry_type, is_dir))
+            if is_dir and entry_type != 'l':
+                subdirs.append(entry.name)
+        self.db.execute('DELETE FROM entries WHERE dir = ?', (rel,))
+        self.db.executemany('INSERT INTO entries VALUES (?, ?, ?, ?)', rows)
+        return subdirs
+
+    def iterfind(self, patterns, exclude=None, types=None, root=None):
+        """Same as ``sh.iterfind``, but answered from the index
+
+        The index is not refreshed. Paths are joined with `root` (defaults to
+        the root of the index). Unlike ``sh.iterfind``, results are not in the
+        order of a walk.
+        """
+        from applib import sh
+
+        match = sh._compile_patterns(patterns)
+        excluded = sh._compile_patterns(exclude) if exclude else None
+        root = self.root if root is None else root
+
+        pruned = {'': False}
+
+        def is_pruned(rel):
+            if rel not in pruned:
+                parent, name = path.split(rel)
+                pruned[rel] = is_pruned(parent) or bool(excluded(name))
+            return pruned[rel]
+
+        if isinstance(patterns, six.string_types):
+            patterns = [patterns]
+        if path.normcase('A') == 'A':
+            # let SQLite do the bulk of the matching (GLOB is case-sensitive)
+            query = 'SELECT dir, name, type FROM entries WHERE {0}'.format(
+                ' OR '.join(['name GLOB ?'] * len(patterns)))
+            args = [p.replace('[!', '[^') for p in patterns]
+        else:
+            query, args = 'SELECT dir, name, type FROM entries', []
+
+        for rel, name, entry_type in self.db.execute(query, args):
+            if not match(name):
+                continue
+            if not sh._type_matches(entry_type or None, types):
+                continue
+            if excluded and (excluded(name) or is_pruned(rel)):
+                continue
+            yield path.join(root, rel, name)
+
+    def close(self):
+        self.db.close()
+
+    def __str__(self):
+        return '{0.__class__.__name__}<{0.root}>'.format(self)
+
+
+def _mtime_ns(st):
+    """Return the mtime of the stat result `st` in nanoseconds"""
+    if hasattr(st, 'st_mtime_ns'):
+        return st.st_mtime_ns
+    return int(st.st_mtime * 1e9)
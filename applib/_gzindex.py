@@ -0,0 +1,311 @@
+# Copyright (c) 2010 ActiveState Software Inc. All rights reserved.
+
+"""Random access to the members of .tar.gz files, zran style
+
+Reading one member out of a tarball normally means decompressing everything
+before it. The index built here is a sidecar SQLite database holding the
+offset of every member in the uncompressed stream, and checkpoints from which
+decompression can be resumed: a compressed offset, the matching uncompressed
+offset, and the 32KB of data before it (the deflate window).
+
+Unlike zlib's zran.c, Python's zlib cannot resume inflating in the middle of
+a byte (there is no inflatePrime); so checkpoints are only taken where the
+deflate stream is byte aligned: at the start of gzip members, and after the
+empty stored blocks marking a full or sync flush (``00 00 ff ff``). pigz,
+and ``TarredFile.pack`` with several workers, write such a flush every block;
+files compressed as a single run by gzip have a single checkpoint, at the
+start.
+"""
+
+import os
+from os import path
+import zlib
+import struct
+import sqlite3
+import tarfile
+from contextlib import closing
+
+__all__ = ['GzipIndex']
+
+_WINDOW_SIZE = 32*1024
+_CHUNK_SIZE = 64*1024
+_FLUSH_MARKER = b'\x00\x00\xff\xff'
+
+
+class GzipIndex(object):
+    """Index of the gzip compressed tarball `filename`
+
+    The index is stored in `index_filename` (defaults to the archive name
+    with '.idx' appended); see ``build``.
+    """
+
+    # default (minimum) uncompressed distance between two checkpoints
+    SPACING = 1024*1024
+
+    def __init__(self, filename, index_filename=None):
+        self.filename = filename
+        self.path = index_filename or filename + '.idx'
+
+    def is_current(self):
+        """Return True if the index exists and matches the archive"""
+        if not path.exists(self.path):
+            return False
+        with _connect(self.path) as db:
+            row = db.execute('SELECT size, mtime FROM archive').fetchone()
+        return row == _signature(self.filename)
+
+    def build(self, spacing=None):
+        """(Re)build the index, decompressing the archive once
+
+        Checkpoints are taken at least `spacing` (uncompressed) bytes apart;
+        each one costs 32KB (before compression) in the index.
+        """
+        spacing = spacing or self.SPACING
+        tmp = self.path + '.tmp'
+        if path.exists(tmp):
+            os.remove(tmp)
+        with open(self.filename, 'rb') as f:
+            stream = _IndexingStream(f, spacing)
+            members = []
+            tf = tarfile.open(fileobj=stream, mode='r|')
+            for tarinfo in tf:
+                members.append((tarinfo.name, tarinfo.offset,
+                                tarinfo.offset_data, tarinfo.size,
+                                tarinfo.type.decode('ascii')))
+            tf.close()
+
+        with _connect(tmp) as db:
+            with db:
+                db.execute('CREATE TABLE archive (size INTEGER, '
+                           'mtime INTEGER)')
+                db.execute('CREATE TABLE checkpoints ('
+                           'uoffset INTEGER PRIMARY KEY, coffset INTEGER, '
+                           'window BLOB)')
+                db.execute('CREATE TABLE members (name TEXT, '
+                           'header_offset INTEGER, data_offset INTEGER, '
+                           'size INTEGER, type TEXT)')
+                db.execute('CREATE INDEX members_name ON members (name)')
+                db.execute('INSERT INTO archive VALUES (?, ?)',
+                           _signature(self.filename))
+                db.executemany(
+                    'INSERT INTO checkpoints VALUES (?, ?, ?)',
+                    [(uoffset, coffset, sqlite3.Binary(zlib.compress(window)))
+                     for (coffset, uoffset, window) in stream.checkpoints])
+                db.executemany('INSERT INTO members VALUES (?, ?, ?, ?, ?)',
+                               members)
+        os.rename(tmp, self.path)  # atomic; readers never see a partial index
+
+    def names(self):
+        """Return the names of the members in the archive"""
+        with _connect(self.path) as db:
+            return [name for (name,) in db.execute(
+                'SELECT name FROM members ORDER BY header_offset')]
+
+    def read(self, name):
+        """Return the contents of the member `name`
+
+        Only the data from the checkpoint before the member is decompressed.
+        Raise KeyError if there is no such member.
+        """
+        with _connect(self.path) as db:
+            row = db.execute(
+                'SELECT data_offset, size FROM members WHERE name = ? '
+                'ORDER BY header_offset DESC', (name,)).fetchone()
+            if row is None:
+                raise KeyError(name)
+            data_offset, size = row
+            uoffset, coffset, window = db.execute(
+                'SELECT uoffset, coffset, window FROM checkpoints '
+                'WHERE uoffset <= ? ORDER BY uoffset DESC',
+                (data_offset,)).fetchone()
+
+        with open(self.filename, 'rb') as f:
+            stream = _GzipStream(f, coffset, zlib.decompress(window))
+            skip = data_offset - uoffset
+            chunks = []
+            while size:
+                chunk = stream.decompress()
+                if not chunk:
+                    raise tarfile.ReadError('unexpected end of data')
+                if skip:
+                    consumed = min(skip, len(chunk))
+                    chunk = chunk[consumed:]
+                    skip -= consumed
+                chunk = chunk[:size]
+                chunks.append(chunk)
+                size -= len(chunk)
+        return b''.join(chunks)
+
+    def __str__(self):
+        return '{0.__class__.__name__}<{0.filename}>'.format(self)
+
+
+class _GzipStream(object):
+    """Decompress a (possibly multi-member) gzip file from `coffset`
+
+    `window` is the data preceding `coffset`, if it is a checkpoint inside a
+    member; None means that a gzip member header starts at `coffset`.
+    Neither the header nor trailer checksums are verified.
+    """
+
+    def __init__(self, fileobj, coffset=0, window=None):
+        self.fileobj = fileobj
+        self.fileobj.seek(coffset)
+        self.coffset = coffset  # offset of the start of `buf`
+        self.buf = b''
+        self.uoffset = 0  # of the data decompressed so far (from `coffset`)
+        self.inflater = None if window is None else _inflater(window)
+
+    def decompress(self):
+        """Return the next piece of decompressed data; b'' at the end"""
+        while True:
+            if self.inflater is None:
+                if not self._start_member():
+                    return b''
+            if not self.buf and not self._fill():
+                raise zlib.error('gzip file ends in the middle of a member')
+            piece = self._next_piece()
+            out = self.inflater.decompress(piece)
+            used = len(piece) - len(self.inflater.unused_data)
+            self._consume(used)
+            self.uoffset += len(out)
+            self._decompressed(piece[:used], out)
+            if self.inflater.eof:
+                self._peek(8)
+                self._consume(8)  # CRC32 and ISIZE
+                self.inflater = None
+            if out:
+                return out
+
+    def _next_piece(self):
+        """Return the compressed data to inflate next"""
+        return self.buf
+
+    def _decompressed(self, piece, out):
+        """Called when `piece` was inflated to `out`"""
+
+    def _member_started(self):
+        """Called at the start of the deflate data of each gzip member"""
+
+    def _start_member(self):
+        """Skip the gzip member header at `coffset`; False at the end"""
+        header = self._peek(10)
+        if not header:
+            return False
+        if header[:3] != b'\x1f\x8b\x08' or len(header) < 10:
+            raise zlib.error('not a gzip file (or trailing garbage)')
+        flags = ord(header[3:4])
+        size = 10
+        if flags & 4:  # FEXTRA
+            size += 2 + struct.unpack('<H', self._peek(size + 2)[size:])[0]
+        for flag in (8, 16):  # FNAME, FCOMMENT: zero terminated
+            if flags & flag:
+                while self.buf.find(b'\x00', size) < 0:
+                    if not self._fill():
+                        raise zlib.error('truncated gzip header')
+                size = self.buf.find(b'\x00', size) + 1
+        if flags & 2:  # FHCRC
+            size += 2
+        if len(self._peek(size)) < size:
+            raise zlib.error('truncated gzip header')
+        self._consume(size)
+        self.inflater = _inflater(None)
+        self._member_started()
+        return True
+
+    def _fill(self):
+        data = self.fileobj.read(_CHUNK_SIZE)
+        self.buf += data
+        return bool(data)
+
+    def _peek(self, size):
+        while len(self.buf) < size and self._fill():
+            pass
+        return self.buf[:size]
+
+    def _consume(self, size):
+        self.buf = self.buf[size:]
+        self.coffset += size
+
+
+class _IndexingStream(_GzipStream):
+    """Read-only file object over the data of a gzip file, for tarfile,
+    recording checkpoints along the way
+
+    Possible checkpoints (after a flush marker) are only kept after
+    checking that decompression indeed resumes from them: an inflater
+    primed with the window must produce the same data as the sequential one.
+    """
+
+    VERIFY_SIZE = 4096  # bytes decompressed identically to keep a checkpoint
+
+    def __init__(self, fileobj, spacing):
+        _GzipStream.__init__(self, fileobj)
+        self.spacing = spacing
+        self.checkpoints = []  # (coffset, uoffset, window)
+        self.window = b''
+        self.candidate = None  # [checkpoint, inflater, verified size]
+        self.out = bytearray()
+
+    def read(self, size=-1):
+        while size < 0 or len(self.out) < size:
+            chunk = self.decompress()
+            if not chunk:
+                break
+            self.out += chunk
+        if size < 0:
+            size = len(self.out)
+        data = bytes(self.out[:size])
+        del self.out[:size]
+        return data
+
+    def _member_started(self):
+        self.candidate = None
+        self.checkpoints.append((self.coffset, self.uoffset, b''))
+        self.window = b''
+
+    def _next_piece(self):
+        # stop at flush markers, to know the uncompressed offset they map to
+        i = self.buf.find(_FLUSH_MARKER)
+        if i >= 0:
+            return self.buf[:i + len(_FLUSH_MARKER)]
+        return self.buf
+
+    def _decompressed(self, piece, out):
+        self.window = (self.window + out[-_WINDOW_SIZE:])[-_WINDOW_SIZE:]
+
+        if self.candidate is not None:
+            checkpoint, inflater, verified = self.candidate
+            try:
+                same = inflater.decompress(piece) == out
+            except zlib.error:
+                same = False
+            if not same:
+                self.candidate = None
+            elif verified + len(out) >= self.VERIFY_SIZE or \
+                    self.inflater.eof:
+                self.checkpoints.append(checkpoint)
+                self.candidate = None
+            else:
+                self.candidate[2] = verified + len(out)
+        elif piece.endswith(_FLUSH_MARKER) and not self.inflater.eof and \
+                self.uoffset - self.checkpoints[-1][1] >= self.spacing:
+            self.candidate = [(self.coffset, self.uoffset, self.window),
+                              _inflater(self.window), 0]
+
+
+def _inflater(window):
+    """Return a raw deflate decompressor primed with `window`"""
+    if window:
+        return zlib.decompressobj(-15, window)
+    return zlib.decompressobj(-15)
+
+
+def _connect(filename):
+    return closing(sqlite3.connect(filename))
+
+
+def _signature(filename):
+    st = os.stat(filename)
+    return (st.st_size, int(st.st_mtime))
+
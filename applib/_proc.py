@@ -5,16 +5,28 @@
 
 from __future__ import unicode_literals
 import os
+from os import path
 import sys
 import time
+import errno
+import signal
+import select
 import subprocess
-from tempfile import TemporaryFile
+import threading
+from tempfile import SpooledTemporaryFile
 import warnings
 
 from applib.misc import xjoin
 from applib.misc import safe_unicode
+from six.moves import queue
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None  # Python 2 without the 'futures' backport
 
-__all__ = ['run', 'RunError', 'RunNonZeroReturn', 'RunTimedout']
+__all__ = ['run', 'iterrun', 'run_many', 'run_many_as_completed',
+           'RunResult', 'RunError', 'RunNonZeroReturn', 'RunTimedout',
+           'RunLimitExceeded', 'RunManyError']
 
 warnings.filterwarnings('ignore', message='.*With\-statements.*',
                         category=DeprecationWarning)
@@ -22,14 +34,17 @@ warnings.filterwarnings('ignore', message='.*With\-statements.*',
 
 class RunError(Exception):  
 
-    def __init__(self, cmd, stdout, stderr, errors):
+    # RunResult of the failed command, if available
+    result = None
+
+    def __init__(self, cmd, stdout, stderr, errors, cwd=None):
         self.stdout = stdout
         self.stderr = stderr
 
         msg = errors[:]
         msg.extend([
             'command: {0}'.format(safe_unicode(cmd)),
-            'pwd: {0}'.format(xjoin(os.getcwd()))])
+            'pwd: {0}'.format(xjoin(os.getcwd(), cwd or ''))])
         
         if stderr is None:
             msg.append(
@@ -45,25 +60,101 @@ class RunError(Exception):
 class RunNonZeroReturn(RunError):
     """The command returned non-zero exit code"""
 
-    def __init__(self, p, cmd, stdout, stderr):
+    def __init__(self, p, cmd, stdout, stderr, cwd=None):
         super(RunNonZeroReturn, self).__init__(cmd, stdout, stderr, [
             'non-zero returncode: {0}'.format(p.returncode)
-            ])
+            ], cwd)
+
+
+class RunLimitExceeded(RunNonZeroReturn):
+    """The command was killed for exceeding one of its resource `limits`
+
+    `limit` is the name of the limit exceeded (eg: 'cpu').
+    """
+
+    def __init__(self, p, cmd, stdout, stderr, limit, value, cwd=None):
+        self.limit = limit
+        RunError.__init__(self, cmd, stdout, stderr, [
+            'non-zero returncode: {0}'.format(p.returncode),
+            'exceeded resource limit: {0} ({1})'.format(limit, value),
+            ], cwd)
 
 
 class RunTimedout(RunError):
-    """process is taking too much time"""
+    """process is taking too much time
 
-    def __init__(self, cmd, timeout, stdout, stderr):
+    `actions` lists the steps taken to stop the process (see ``run``)
+    """
+
+    def __init__(self, cmd, timeout, stdout, stderr, actions=(), cwd=None):
+        self.actions = list(actions)
         super(RunTimedout, self).__init__(cmd, stdout, stderr, [
             'timed out; ergo process is terminated',
             'seconds elapsed: {0}'.format(timeout),
-            ])
+            ] + self.actions, cwd)
 
-    
-# TODO: support for incremental results (sometimes a process run for a few
-# minutes, but we need to send the stdout as soon as it appears.
-def run(cmd, merge_streams=False, timeout=None, env=None):
+
+class RunManyError(RunError):
+    """One or more of the commands passed to ``run_many`` failed
+
+    `errors` maps the index of each failed command to its RunError, and
+    `results` holds the (stdout, stderr) of every command in order (None for
+    the failed ones).
+    """
+
+    def __init__(self, cmds, errors, results):
+        self.stdout = self.stderr = None
+        self.errors = errors
+        self.results = results
+
+        msg = ['{0} of {1} commands failed'.format(len(errors), len(cmds))]
+        for index in sorted(errors):
+            msg.append('#{0}: {1}'.format(
+                index, safe_unicode(errors[index]).split('\n', 1)[0]))
+            msg.append('  command: {0}'.format(safe_unicode(cmds[index])))
+        super(RunError, self).__init__('\n'.join(msg))
+
+
+class RunResult(object):
+    """Outcome of a command, with its resource usage
+
+    Returned by ``run`` when called with `result=True`, and attached as the
+    `result` attribute of the RunError raised for a failed command. For
+    compatibility, it unpacks as (stdout, stderr).
+
+    Times are in seconds and `max_rss` is in bytes. CPU times and `max_rss`
+    are None on platforms without ``os.wait4`` (Windows). `signal` is the
+    number of the signal that killed the process, if any. `stdout_size` and
+    `stderr_size` count every byte the process wrote, including those not
+    retained because of `max_capture`.
+    """
+
+    def __init__(self):
+        self.stdout = self.stderr = None
+        self.returncode = None
+        self.wall_time = None
+        self.user_time = self.system_time = self.max_rss = None
+        self.stdout_size = self.stderr_size = 0
+
+    @property
+    def signal(self):
+        if self.returncode is not None and self.returncode < 0:
+            return -self.returncode
+        return None
+
+    def __iter__(self):
+        return iter((self.stdout, self.stderr))
+
+    def __repr__(self):
+        return ('<RunResult returncode={0.returncode} wall_time={0.wall_time} '
+                'user_time={0.user_time} system_time={0.system_time} '
+                'max_rss={0.max_rss}>'.format(self))
+
+
+def run(cmd, merge_streams=False, timeout=None, env=None, grace=None,
+        process_group=False, spool_size=1024*1024, max_capture=None,
+        result=False, limits=None, nice=None, ionice=None, cgroup=None,
+        cwd=None):
     """Improved replacement for commands.getoutput()
 
     The following features are implemented:
@@ -71,12 +162,318 @@ def run(cmd, merge_streams=False, timeout=None, env=None):
      - timeout (in seconds)
      - support for merged streams (stdout+stderr together)
      
-    `cmd` can be a full command string, or list of prog/args.
+    `cmd` can be a full command string, or list of prog/args. It is run in
+    the directory `cwd`, if given; unlike using ``cd``, this does not affect
+    other threads.
+
+    A timed out process is sent SIGTERM. If `grace` (in seconds) is given and
+    the process is still alive after that long, it is sent SIGKILL; otherwise
+    it is left running. If
+    `process_group` is True, the command is run in a new process group (POSIX
+    only) and the signals are sent to the whole group, so that its children
+    are stopped as well. The steps taken are reported in RunTimedout.
+
+    Output is kept in memory up to `spool_size` bytes per stream, and spilled
+    to a temporary file beyond that. If `max_capture` is set, only the first
+    and last `max_capture`/2 bytes of each stream are retained, with a marker
+    in between noting how much was left out.
+
+    The following can be used to confine the process (POSIX only):
+
+     - limits: dict of resource limits to set, by the name of the
+       ``resource.RLIMIT_*`` constant; eg: {'as': 2*1024**3, 'cpu': 600,
+       'nofile': 1024, 'fsize': 10*1024**3}. A value is either the soft limit
+       or a (soft, hard) tuple.
+     - nice: niceness increment
+     - ionice: (class, level) I/O scheduling priority, where class is one of
+       'realtime', 'best-effort' or 'idle' (Linux only)
+     - cgroup: cgroup v2 to place the process in; absolute, or relative to
+       /sys/fs/cgroup (Linux only)
+
+    RunLimitExceeded is raised if the process was killed for going over its
+    'cpu' or 'fsize' limit. Other limits make system calls fail in the
+    process, which only shows up as RunNonZeroReturn.
+
+    On Linux these are applied from the parent just after the process is
+    started, so children it forks in the first instants escape them.
+    Elsewhere they are applied in the child before exec, which is not safe
+    if other threads are running (as in ``run_many``).
+
+    Output is read till the process exits; background processes started by
+    `cmd` are not waited for, and whatever they write afterwards is lost.
 
     Note that returned data is of *undecoded* str/bytes type (not unicode)
 
-    Return (stdout, stderr)
+    Use ``iterrun`` to get the output incrementally, as the process runs.
+
+    Return (stdout, stderr), or a RunResult if `result` is True.
+    """
+    outputs = dict(stdout=_OutputBuffer(spool_size, max_capture),
+                   stderr=_OutputBuffer(spool_size, max_capture))
+    run_result = RunResult()
+    try:
+        for _ in _iterrun(cmd, merge_streams, timeout, env, cwd, grace,
+                          process_group, outputs, run_result,
+                          _Restrictions.create(limits, nice, ionice, cgroup)):
+            pass
+        if result:
+            return run_result
+        return run_result.stdout, run_result.stderr
+    finally:
+        for output in outputs.values():
+            output.close()
+
+
+def run_many(cmds, max_workers=None, fail_fast=False, **kwargs):
+    """Run the given commands concurrently and return their results in order
+
+    At most `max_workers` commands run at the same time (by default, as many
+    as ``concurrent.futures.ThreadPoolExecutor`` picks). The remaining keyword
+    arguments are passed to ``run``.
+
+    If `fail_fast` is True, the first RunError is raised as soon as it occurs
+    and commands not started yet are skipped (running ones are waited for).
+    Otherwise all commands are run and a RunManyError, carrying the individual
+    errors along with the results of the successful commands, is raised in
+    the end.
+
+    Return the list of (stdout, stderr)
+    """
+    cmds = list(cmds)
+    results = [None] * len(cmds)
+    for index, result in run_many_as_completed(
+            cmds, max_workers, fail_fast, **kwargs):
+        results[index] = result
+    return results
+
+
+def run_many_as_completed(cmds, max_workers=None, fail_fast=False, **kwargs):
+    """Like ``run_many``, but yield (index, (stdout, stderr)) as they complete
+
+    `index` is the position of the command in `cmds`. Without `fail_fast`,
+    a RunManyError for the failed commands is raised after the rest has been
+    yielded.
+    """
+    cmds = list(cmds)
+    errors = {}
+    results = [None] * len(cmds)
+    for index, result in _run_many(cmds, max_workers, fail_fast, kwargs):
+        if isinstance(result, RunError):
+            errors[index] = result
+        else:
+            results[index] = result
+            yield index, result
+    if errors:
+        raise RunManyError(cmds, errors, results)
+
+
+def _run_many(cmds, max_workers, fail_fast, kwargs):
+    """Yield (index, result) for `cmds` as they complete
+
+    result is the RunError, if the command failed (raised, if `fail_fast`).
+    """
+    def run_one(index):
+        try:
+            return index, run(cmds[index], **kwargs)
+        except RunError as e:
+            if fail_fast:
+                raise
+            return index, e
+
+    if futures is None or max_workers == 1:
+        for index in range(len(cmds)):
+            yield run_one(index)
+        return
+
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = [executor.submit(run_one, i) for i in range(len(cmds))]
+        try:
+            for future in futures.as_completed(pending):
+                yield future.result()
+        finally:
+            # on error (or if the caller stopped iterating) do not start any
+            # more commands
+            for future in pending:
+                future.cancel()
+
+
+def iterrun(cmd, merge_streams=False, timeout=None, env=None, grace=None,
+            process_group=False, lines=False, limits=None, nice=None,
+            ionice=None, cgroup=None, cwd=None):
+    """Run `cmd` and yield its output as soon as it appears
+
+    Yield (stream, data) tuples where `stream` is either 'stdout' or 'stderr'
+    (always 'stdout' if `merge_streams` is set) and `data` is the undecoded
+    bytes just read from it. If `lines` is True, `data` is a single line
+    (including its trailing newline) rather than an arbitrary chunk.
+
+    `timeout` applies to the whole run and is enforced even if the process
+    produces no output; other arguments are as in ``run``.
+    Like ``run``, RunTimedout or RunNonZeroReturn is raised at the end; as the
+    output is not retained, they only carry its tail.
+
+    If the generator is closed before completion, the process is killed.
+    """
+    chunks = _iterrun(cmd, merge_streams, timeout, env, cwd, grace,
+                      process_group, dict(stdout=_Tail(), stderr=_Tail()),
+                      RunResult(),
+                      _Restrictions.create(limits, nice, ionice, cgroup))
+    if lines:
+        chunks = _iter_lines(chunks)
+    return chunks
+
+
+def _iterrun(cmd, merge_streams, timeout, env, cwd, grace, process_group,
+             outputs, result, restrictions):
+    """Run `cmd`, yielding (stream, data) as it is read
+
+    Data is also written to outputs[stream], whose ``getvalue()`` gives the
+    output stored in the RunResult `result` once the process is done.
+    `restrictions` is a _Restrictions object (or None).
+    """
+    cmd, shell = _prepare_cmd(cmd)
+    deadline = _deadline(timeout)
+    t_nought = time.time()
+
+    def finish():
+        result.wall_time = time.time() - t_nought
+        result.returncode = p.returncode
+        rusage = getattr(p, 'rusage', None)
+        if rusage is not None:
+            result.user_time = rusage.ru_utime
+            result.system_time = rusage.ru_stime
+            # kilobytes on Linux, bytes on OS X
+            result.max_rss = rusage.ru_maxrss * (
+                1 if sys.platform == 'darwin' else 1024)
+        result.stdout = outputs['stdout'].getvalue()
+        result.stderr = outputs['stderr'].getvalue()
+        result.stdout_size = outputs['stdout'].size
+        result.stderr_size = outputs['stderr'].size
+        return result.stdout, None if merge_streams else result.stderr
+
+    p = subprocess.Popen(
+        cmd, env=env, cwd=cwd, shell=shell, stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT if merge_streams else subprocess.PIPE,
+        **_popen_kwargs(process_group, restrictions))
+    if restrictions:
+        restrictions.apply_to(p)
+    timed_out = False
+    try:
+        try:
+            for stream, data in _iter_pipes(p, deadline):
+                outputs[stream].write(data)
+                yield stream, data
+            exited = _wait(p, deadline)
+        except _DeadlineReached:
+            exited = False
+
+        if not exited:
+            timed_out = True
+            actions = _stop(p, grace, process_group)
+            e = RunTimedout(cmd, timeout, *(finish() + (actions, cwd)))
+            e.result = result
+            raise e
+    finally:
+        # abandoned (eg: the iterrun generator was closed); a timed out
+        # process is left to ``_stop``
+        if not timed_out and p.poll() is None:
+            if process_group:
+                _killpg(p, signal.SIGKILL)
+            else:
+                p.kill()
+            p.wait()
+        for f in (p.stdout, p.stderr):
+            if f is not None:
+                f.close()
+
+    stdout, stderr = finish()
+    if p.returncode != 0:
+        exceeded = restrictions and restrictions.exceeded(
+            p.returncode, getattr(p, 'rusage', None))
+        if exceeded:
+            e = RunLimitExceeded(p, cmd, stdout, stderr, *exceeded, cwd=cwd)
+        else:
+            e = RunNonZeroReturn(p, cmd, stdout, stderr, cwd)
+        e.result = result
+        raise e
+
+
+class _OutputBuffer(object):
+    """Capture buffer for the output of a process
+
+    Data is held in memory up to `spool_size` bytes, and in a temporary file
+    beyond that. If `max_capture` is not None, only the head and tail of the
+    data (`max_capture`/2 bytes each) are retained.
     """
+
+    def __init__(self, spool_size, max_capture=None):
+        self.size = 0
+        self._head = SpooledTemporaryFile(max_size=spool_size)
+        if max_capture is None:
+            self._head_size = None
+        else:
+            self._head_size = max_capture // 2
+            self._tail = _Tail(max_capture - self._head_size)
+
+    def write(self, data):
+        if self._head_size is None:
+            self._head.write(data)
+        else:
+            room = max(0, self._head_size - self.size)
+            self._head.write(data[:room])
+            if len(data) > room:
+                self._tail.write(data[room:])
+        self.size += len(data)
+
+    def getvalue(self):
+        self._head.seek(0)
+        value = self._head.read()
+        if self._head_size is not None:
+            tail = self._tail.getvalue()
+            omitted = self.size - len(value) - len(tail)
+            if omitted:
+                value += '\n[... {0} bytes omitted ...]\n'.format(
+                    omitted).encode('ascii')
+            value += tail
+        return value
+
+    def close(self):
+        self._head.close()
+
+
+class _Tail(object):
+    """Retain the last `size` bytes written"""
+
+    def __init__(self, size=None):
+        self.size = 0
+        self._max_size = _TAIL_SIZE if size is None else size
+        self._data = bytearray()
+
+    def write(self, data):
+        self.size += len(data)
+        self._data.extend(data)
+        excess = len(self._data) - self._max_size
+        if excess > 0:
+            del self._data[:excess]
+
+    def getvalue(self):
+        return bytes(self._data)
+
+
+# Bytes of output retained by ``iterrun`` for error messages; enough to fill
+# what ``_limit_str`` shows even if every character is multi-byte.
+_TAIL_SIZE = 80*15*4
+
+# Maximum number of bytes to read from a pipe at once
+_CHUNK_SIZE = 64*1024
+
+
+class _DeadlineReached(Exception):
+    """Timeout reached while waiting for the process"""
+
+
+def _prepare_cmd(cmd):
+    """Return (cmd, shell) to pass on to subprocess.Popen"""
     if isinstance(cmd, (list, tuple)):
         shell = False
     else:
@@ -85,50 +482,466 @@ def run(cmd, merge_streams=False, timeout=None, env=None):
         # http://firefly.activestate.com/sridharr/pypm/ticket/126#comment:3
         if sys.platform.startswith('win') and cmd.startswith('"'):
             cmd = '"{0}"'.format(cmd)
+    return cmd, shell
 
-    # redirect stdout and stderr to temporary *files*
-    with TemporaryFile() as outf:
-        with TemporaryFile() as errf:
-            p = subprocess.Popen(cmd, env=env, shell=shell, stdout=outf,
-                                 stderr=outf if merge_streams else errf)
-    
-            if timeout is None:
-                p.wait()
-            else:
-                # poll for terminated status till timeout is reached
-                t_nought = time.time()
-                seconds_passed = 0
-                while True:
-                    if p.poll() is not None:
-                        break
-                    seconds_passed = time.time() - t_nought
-                    if timeout and seconds_passed > timeout:
-                        p.terminate()
-                        raise RunTimedout(
-                            cmd, timeout,
-                            _read_tmpfd(outf),
-                            None if merge_streams else _read_tmpfd(errf))
-                    time.sleep(0.1)
-
-            # the process has exited by now; nothing will to be written to
-            # outfd/errfd anymore.
-            stdout = _read_tmpfd(outf)
-            stderr = _read_tmpfd(errf)
 
-    if p.returncode != 0:
-        raise RunNonZeroReturn(p, cmd, stdout, None if merge_streams else stderr)
+def _deadline(timeout):
+    """Return the absolute time by which `timeout` expires (None for never)"""
+    if not timeout:
+        return None
+    return time.time() + timeout
+
+
+def _remaining(deadline):
+    """Return seconds left till `deadline` (None if there is no deadline)"""
+    if deadline is None:
+        return None
+    return max(0, deadline - time.time())
+
+
+def _popen_kwargs(process_group, restrictions=None):
+    """Return the extra subprocess.Popen arguments
+
+    for `process_group` and the _Restrictions `restrictions`
+    """
+    kwargs = {}
+    preexec_fns = []
+    if process_group:
+        if sys.platform.startswith('win'):
+            raise ValueError('process_group is not supported on Windows')
+        if sys.version_info[:2] >= (3, 2):
+            kwargs['start_new_session'] = True
+        else:
+            preexec_fns.append(os.setsid)
+    if restrictions and not restrictions.from_parent:
+        preexec_fns.append(restrictions.apply)
+
+    if preexec_fns:
+        def preexec_fn():
+            for fn in preexec_fns:
+                fn()
+        kwargs['preexec_fn'] = preexec_fn
+    return kwargs
+
+
+class _Restrictions(object):
+    """Resource limits, priorities and cgroup to apply to a child process
+
+    Arguments are validated, and everything that can be is worked out, in the
+    parent. Where ``resource.prlimit`` is available (Linux), the restrictions
+    are then applied by the parent, with ``apply_to`` right after the process
+    is started; running code between fork and exec (``preexec_fn``) is not
+    safe when other threads are running, as in ``run_many``. Elsewhere,
+    ``apply`` is run in the child (after fork, before exec).
+    """
+
+    IOPRIO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+    # ioprio_set(2) has no wrapper in libc, nor in the os module
+    IOPRIO_SET_SYSCALLS = {
+        'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30,
+        'armv7l': 314, 'ppc64le': 273, 's390x': 282}
+
+    # signal sent when a soft limit is exceeded
+    SIGNALS = {'cpu': 'SIGXCPU', 'fsize': 'SIGXFSZ'}
+
+    @classmethod
+    def create(cls, limits, nice, ionice, cgroup):
+        """Return a _Restrictions object, or None if nothing is to be restricted"""
+        if not (limits or nice is not None or ionice or cgroup):
+            return None
+        return cls(limits or {}, nice, ionice, cgroup)
+
+    def __init__(self, limits, nice, ionice, cgroup):
+        if sys.platform.startswith('win'):
+            raise ValueError(
+                'limits, nice, ionice and cgroup are not supported on Windows')
+        import resource
+
+        self.from_parent = hasattr(resource, 'prlimit')
+        self.limits = limits
+        self.rlimits = []
+        for name, value in limits.items():
+            rlimit = getattr(resource, 'RLIMIT_' + name.upper(), None)
+            if rlimit is None:
+                raise ValueError('unknown resource limit: {0}'.format(name))
+            if not isinstance(value, (tuple, list)):
+                value = (value, resource.getrlimit(rlimit)[1])
+            self.rlimits.append((rlimit, tuple(value)))
+
+        self.nice = nice
+
+        self.ioprio = None
+        if ionice:
+            self.ioprio = self._get_ioprio(*ionice)
+
+        self.cgroup_procs = None
+        if cgroup:
+            if not sys.platform.startswith('linux'):
+                raise ValueError('cgroup is only supported on Linux')
+            self.cgroup_procs = path.join('/sys/fs/cgroup', cgroup,
+                                          'cgroup.procs')
+            if not path.exists(self.cgroup_procs):
+                raise ValueError('not a cgroup v2 group: {0}'.format(cgroup))
+
+    def _get_ioprio(self, ioclass, level=0):
+        """Return (syscall, syscall number, ioprio) to set the given I/O
+        priority"""
+        import ctypes, platform
+        syscall_nr = self.IOPRIO_SET_SYSCALLS.get(platform.machine())
+        if not sys.platform.startswith('linux') or syscall_nr is None:
+            raise ValueError('ionice is not supported on this platform')
+        if ioclass not in self.IOPRIO_CLASSES:
+            raise ValueError('invalid ionice class: {0}'.format(ioclass))
+        ioprio = self.IOPRIO_CLASSES[ioclass] << 13 | level
+        libc = ctypes.CDLL(None, use_errno=True)
+        return libc.syscall, syscall_nr, ioprio
+
+    def apply(self):
+        """Apply the restrictions to the current process"""
+        import resource
+        if self.cgroup_procs:
+            with open(self.cgroup_procs, 'w') as f:
+                f.write(str(os.getpid()))
+        for rlimit, value in self.rlimits:
+            resource.setrlimit(rlimit, value)
+        if self.nice is not None:
+            os.nice(self.nice)
+        if self.ioprio is not None:
+            self._set_ioprio(0)  # ie: self
+
+    def apply_to(self, p):
+        """Apply the restrictions to the just started process `p`
+
+        Unless they are applied in the child (see ``from_parent``), in
+        which case this does nothing. `p` is killed if this fails.
+        """
+        if not self.from_parent:
+            return
+        import resource
+        try:
+            if self.cgroup_procs:
+                with open(self.cgroup_procs, 'w') as f:
+                    f.write(str(p.pid))
+            for rlimit, value in self.rlimits:
+                resource.prlimit(p.pid, rlimit, value)
+            if self.nice is not None:
+                os.setpriority(os.PRIO_PROCESS, p.pid, self.nice +
+                               os.getpriority(os.PRIO_PROCESS, p.pid))
+            if self.ioprio is not None:
+                self._set_ioprio(p.pid)
+        except Exception:
+            p.kill()
+            raise
+
+    def _set_ioprio(self, pid):
+        # ioprio_set(IOPRIO_WHO_PROCESS, pid, ioprio)
+        syscall, syscall_nr, ioprio = self.ioprio
+        if syscall(syscall_nr, 1, pid, ioprio) != 0:
+            import ctypes
+            err = ctypes.get_errno()
+            raise OSError(err, 'ioprio_set: ' + os.strerror(err))
+
+    def exceeded(self, returncode, rusage=None):
+        """Return (limit name, value) if the process was killed for exceeding it
+
+        `rusage` is used to detect the hard CPU limit, for which the process
+        is killed with SIGKILL.
+        """
+        for name, signame in self.SIGNALS.items():
+            if name in self.limits and \
+                    returncode == -getattr(signal, signame, None):
+                return name, self.limits[name]
+        if 'cpu' in self.limits and returncode == -signal.SIGKILL and \
+                rusage is not None:
+            limit = self.limits['cpu']
+            if isinstance(limit, (tuple, list)):
+                limit = limit[1]
+            if rusage.ru_utime + rusage.ru_stime >= limit:
+                return 'cpu', self.limits['cpu']
+        return None
+
+
+def _wait(p, deadline):
+    """Wait for the process to exit
+
+    Return False if `deadline` was reached before that happened.
+
+    Rather than polling at fixed intervals, we wait on a pidfd (Linux) which
+    becomes readable as soon as the process exits. Elsewhere, we poll with
+    exponential backoff starting with sub-millisecond intervals (or use
+    Popen.wait, which does the same); either way short commands return almost
+    as soon as they finish.
+    """
+    if _reap(p):
+        return True
+    if deadline is None:
+        _reap(p, block=True)
+        return True
+
+    if hasattr(os, 'pidfd_open'):
+        try:
+            pidfd = os.pidfd_open(p.pid)
+        except OSError:
+            pass  # eg: kernel older than 5.3
+        else:
+            try:
+                poller = select.poll()
+                poller.register(pidfd, select.POLLIN)
+                poller.poll(_remaining(deadline)*1000)
+            finally:
+                os.close(pidfd)
+            return _reap(p)
+
+    if not hasattr(os, 'wait4') and sys.version_info[0] >= 3:
+        try:
+            p.wait(timeout=_remaining(deadline))
+        except subprocess.TimeoutExpired:
+            return False
+        return True
+
+    delay = 0.0005
+    while not _reap(p):
+        remaining = _remaining(deadline)
+        if remaining == 0:
+            return False
+        delay = min(delay * 2, remaining, 0.05)
+        time.sleep(delay)
+    return True
+
+
+def _reap(p, block=False):
+    """Reap the process if it has exited (or wait for it, if `block`)
+
+    Where available, ``os.wait4`` is used so that the resource usage of the
+    process can be recorded (as `p.rusage`).
+
+    Return True if the process has exited.
+    """
+    if p.returncode is not None:
+        return True
+    if not hasattr(os, 'wait4'):
+        if block:
+            p.wait()
+        return p.poll() is not None
+
+    try:
+        pid, status, rusage = os.wait4(p.pid, 0 if block else os.WNOHANG)
+    except OSError as e:
+        if e.errno != errno.ECHILD:
+            raise
+        # already reaped elsewhere (eg: SIGCHLD is ignored)
+        return p.poll() is not None
+    if pid == 0:
+        return False
+    p.rusage = rusage
+    if os.WIFSIGNALED(status):
+        p.returncode = -os.WTERMSIG(status)
     else:
-        return stdout, stderr
+        p.returncode = os.WEXITSTATUS(status)
+    return True
+
+
+def _stop(p, grace, process_group):
+    """Stop the timed out process `p`
+
+    Send SIGTERM and, if `grace` is not None, escalate to SIGKILL when the
+    process is still running `grace` seconds later. Otherwise the process is
+    left running if it ignores SIGTERM. Signals go to the entire process
+    group if `process_group` is True.
+
+    Return the list of actions taken (for reporting in RunTimedout).
+    """
+    target, terminate, kill = _signallers(p, process_group)
+    terminate()
+    actions = ['sent SIGTERM to {0}'.format(target)]
+    if grace is None:
+        # reaped if it exits promptly, so that the result has its signal
+        if not _wait(p, time.time() + _TERM_WAIT):
+            actions.append('still running after {0} seconds; left '
+                           'running'.format(_TERM_WAIT))
+        return actions
+
+    if not _wait(p, time.time() + grace):
+        kill()
+        actions.append('still running after {0} seconds of grace; '
+                       'sent SIGKILL to {1}'.format(grace, target))
+        _reap(p, block=True)
+    elif process_group and _killpg(p, signal.SIGKILL):
+        # the leader exited, but some of its children did not
+        actions.append('sent SIGKILL to the remaining members of '
+                       '{0}'.format(target))
+    return actions
+
+
+# Seconds to wait for a process to exit on SIGTERM, when there is no `grace`
+_TERM_WAIT = 0.1
+
+
+def _signallers(p, process_group):
+    """Return (description, terminate, kill) for stopping the process `p`
+
+    `p` may be a subprocess.Popen or an asyncio.subprocess.Process.
+    """
+    if process_group:
+        return ('process group {0}'.format(p.pid),
+                lambda: _killpg(p, signal.SIGTERM),
+                lambda: _killpg(p, signal.SIGKILL))
+    return 'process {0}'.format(p.pid), p.terminate, p.kill
+
+
+def _killpg(p, sig):
+    """Send `sig` to the process group led by `p`
+
+    Return False if the group no longer exists.
+    """
+    try:
+        os.killpg(p.pid, sig)
+    except OSError as e:
+        if e.errno in (errno.ESRCH, errno.EPERM):
+            # EPERM: macOS reports this for a group of zombies
+            return False
+        raise
+    return True
+
 
+def _iter_pipes(p, deadline):
+    """Yield (stream, data) from the stdout/stderr pipes of `p`
 
-def _read_tmpfd(fil):
-    """Read from a temporary file object
+    Reading stops at EOF or, as background children of the process may keep
+    the pipes open, once the process has exited and what is left in the
+    pipes has been read (giving up after _DRAIN_GRACE seconds). The process
+    is reaped by then.
 
-    Call this method only when nothing more will be written to the temporary
-    file - i.e., all the writing has already been done.
+    Raise _DeadlineReached if `deadline` is reached before that.
     """
-    fil.seek(0)
-    return fil.read()
+    pipes = dict((f.fileno(), name) for (f, name) in [
+        (p.stdout, 'stdout'), (p.stderr, 'stderr')] if f is not None)
+
+    if not hasattr(select, 'poll'):
+        # Windows cannot select() on pipes
+        for item in _iter_pipes_threaded(p, pipes, deadline):
+            yield item
+        return
+
+    poller = select.poll()
+    for fd in pipes:
+        poller.register(fd, select.POLLIN)
+    # a pidfd becomes readable when the process exits; without one, check
+    # for that between polls, backing off as in ``_wait``
+    pidfd = _pidfd_open(p)
+    if pidfd is not None:
+        poller.register(pidfd, select.POLLIN)
+    delay = 0.0005
+    drain_deadline = None
+    try:
+        while pipes:
+            exited = drain_deadline is not None
+            if exited:
+                remaining = _remaining(drain_deadline)
+                if remaining == 0:
+                    break
+            else:
+                remaining = _remaining(deadline)
+                if remaining == 0:
+                    raise _DeadlineReached()
+                if pidfd is None:
+                    delay = min(delay * 2, 0.05)
+                    remaining = delay if remaining is None else \
+                        min(delay, remaining)
+            events = poller.poll(
+                None if remaining is None else remaining*1000)
+            if exited and not events:
+                break  # the pipes are held open by some other process
+            for fd, event in events:
+                if fd == pidfd:
+                    continue
+                # poll() returned, so this will not block
+                data = os.read(fd, _CHUNK_SIZE)
+                if data:
+                    yield pipes[fd], data
+                else:
+                    poller.unregister(fd)
+                    del pipes[fd]
+            if not exited and _reap(p):
+                drain_deadline = time.time() + _DRAIN_GRACE
+                if pidfd is not None:
+                    poller.unregister(pidfd)
+    finally:
+        if pidfd is not None:
+            os.close(pidfd)
+
+
+def _pidfd_open(p):
+    """Return a pidfd for the process `p`, or None if not supported"""
+    if not hasattr(os, 'pidfd_open'):
+        return None
+    try:
+        return os.pidfd_open(p.pid)
+    except OSError:
+        return None  # eg: kernel older than 5.3
+
+
+def _iter_pipes_threaded(p, pipes, deadline):
+    """Fallback for ``_iter_pipes`` using one reader thread per pipe"""
+    q = queue.Queue()
+
+    def reader(fd, name):
+        while True:
+            data = os.read(fd, _CHUNK_SIZE)
+            q.put((name, data))
+            if not data:
+                break
+
+    for fd, name in pipes.items():
+        t = threading.Thread(target=reader, args=(fd, name))
+        t.daemon = True
+        t.start()
+
+    open_pipes = len(pipes)
+    drain_deadline = None
+    while open_pipes:
+        if drain_deadline is None:
+            remaining = _remaining(deadline)
+            if remaining == 0:
+                raise _DeadlineReached()
+            timeout = 0.05 if remaining is None else min(0.05, remaining)
+        else:
+            timeout = _remaining(drain_deadline)
+            if timeout == 0:
+                break
+        try:
+            name, data = q.get(timeout=timeout)
+        except queue.Empty:
+            if drain_deadline is not None:
+                break  # the pipes are held open by some other process
+        else:
+            if data:
+                yield name, data
+            else:
+                open_pipes -= 1
+        if drain_deadline is None and _reap(p):
+            drain_deadline = time.time() + _DRAIN_GRACE
+
+
+# Seconds to keep reading output after the process exited, if its pipes are
+# still open (ie: inherited by background processes)
+_DRAIN_GRACE = 0.1
+
+
+def _iter_lines(chunks):
+    """Regroup the (stream, data) items from `chunks` into lines"""
+    partial = {}
+    for stream, data in chunks:
+        # only on b'\n'; splitlines() would split on b'\r' and others too
+        lines = (partial.pop(stream, b'') + data).split(b'\n')
+        if lines[-1]:
+            partial[stream] = lines[-1]
+        for line in lines[:-1]:
+            yield stream, line + b'\n'
+    for stream, data in partial.items():
+        if data:
+            yield stream, data
 
 
 def _limit_str(s, maxchars=80*15):
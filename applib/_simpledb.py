@@ -25,7 +25,7 @@ from contextlib import contextmanager
 import json
 
 from sqlalchemy import Table, Column, MetaData
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, and_, bindparam
 from sqlalchemy.types import String, Text, Boolean, PickleType
 from sqlalchemy.orm import sessionmaker, scoped_session, mapper
 
@@ -119,6 +119,80 @@ class SimpleDatabase(object):
     def close(self):
         self.engine.dispose()
 
+    def bulk_insert(self, rows, chunk_size=5000):
+        """Insert `rows` (dicts of all the FIELDS, or SimpleObjects)
+
+        Unlike adding mapped objects to a session, this runs a single INSERT
+        statement with ``executemany``, one transaction per `chunk_size` rows.
+        Objects already loaded in sessions are not refreshed.
+
+        Return the number of rows inserted.
+        """
+        return self._bulk_execute(
+            rows, chunk_size, [(self.table.insert(), lambda row: row)])
+
+    def bulk_upsert(self, rows, key=None, chunk_size=5000):
+        """Same as ``bulk_insert``, but replace the existing rows that have the
+        same values for the `key` columns (default: the primary key)
+        """
+        primary_keys = [column.name for column in self.table.primary_key]
+        key = list(key or primary_keys)
+        if set(key) == set(primary_keys):
+            return self._bulk_execute(rows, chunk_size, [(
+                self.table.insert().prefix_with('OR REPLACE'),
+                lambda row: row)])
+
+        # not a constraint that SQLite can resolve conflicts on; so do what
+        # REPLACE does by hand
+        delete = self.table.delete().where(and_(*[
+            self.table.c[name] == bindparam('key_' + name) for name in key]))
+        return self._bulk_execute(
+            rows, chunk_size,
+            [(delete, lambda row: dict(('key_' + name, row[name])
+                                       for name in key)),
+             (self.table.insert(), lambda row: row)],
+            key)
+
+    def _bulk_execute(self, rows, chunk_size, statements, key=None):
+        """Execute `statements` for each chunk of `rows`, in a transaction
+
+        `statements` are (statement, function returning the parameters of the
+        statement for a row). If `key` is given, only the last of the rows
+        of a chunk with the same values for the `key` columns is kept (as
+        with REPLACE, whatever the chunk size).
+        """
+        assert chunk_size > 0
+        count = 0
+        conn = self.engine.connect()
+        try:
+            chunk = []
+            for row in rows:
+                if isinstance(row, SimpleObject):
+                    row = row.to_dict()
+                chunk.append(row)
+                if len(chunk) == chunk_size:
+                    count += self._execute_chunk(
+                        conn, _dedupe(chunk, key), statements)
+                    chunk = []
+            if chunk:
+                count += self._execute_chunk(
+                    conn, _dedupe(chunk, key), statements)
+        finally:
+            conn.close()
+        return count
+
+    @staticmethod
+    def _execute_chunk(conn, chunk, statements):
+        trans = conn.begin()
+        try:
+            for statement, params in statements:
+                conn.execute(statement, [params(row) for row in chunk])
+        except:
+            trans.rollback()
+            raise
+        trans.commit()
+        return len(chunk)
+
     @contextmanager
     def transaction(self, session=None):
         """Start a new transaction based on the passed session object. If session
@@ -146,6 +220,17 @@ class SimpleDatabase(object):
         return '{0.__class__.__name__}<{0.path}>'.format(self)
 
 
+def _dedupe(rows, key):
+    """Return `rows` without those followed by a row with the same values for
+    the `key` columns (all of them if `key` is None)"""
+    if key is None:
+        return rows
+    last = dict((tuple(row[name] for name in key), i)
+                for (i, row) in enumerate(rows))
+    return [row for (i, row) in enumerate(rows)
+            if last[tuple(row[name] for name in key)] == i]
+
+
 class SimpleObject(object):
     """Object with a collection of fields.
 
@@ -4,13 +4,29 @@
 """
 
 import os
+import re
+import sys
+import errno
+import binascii
+import threading
 from os import path
 import shutil
 import tempfile
-from fnmatch import fnmatch
+from fnmatch import translate as fnmatch_translate
 from contextlib import contextmanager
+import six
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir  # backport for Python < 3.5
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None  # Python 2 without the 'futures' backport
 
 from applib._proc import *
+if sys.version_info[:2] >= (3, 5):
+    from applib._aproc import *
 
 
 #
@@ -21,40 +37,146 @@ class PackError(Exception):
     """Error during pack or unpack"""
     
 
-def unpack_archive(filename, pth='.'):
+def unpack_archive(filename, pth='.', workers=1, cache=None):
     """Unpack the archive under ``path``
+
+    The working directory is not changed; so archives can be unpacked from
+    multiple threads at once. The archive format is detected from the first
+    bytes of the file.
+
+    The members of zip files are inflated in `workers` threads (None for as
+    many as ``concurrent.futures`` sees fit); tarballs, being a single
+    compressed stream, are always extracted serially.
+
+    With an ``ExtractionCache`` as `cache`, archives with the same contents
+    are extracted only once.
     
     Return (unpacked directory path, filetype)
     """
-    from applib import _compression
-    
     assert path.isfile(filename), 'not a file: %s' % filename
     assert path.isdir(pth)
     
-    for filetype, implementor in _compression.implementors.items():
-        if implementor.is_valid(filename):
-            with cd(pth):
-                return (implementor(filename).extract(), filetype)
-    else:
+    if cache is not None:
+        return cache.unpack(filename, pth, workers)
+    filetype, implementor = _archive_implementor(filename)
+    return (implementor(filename, workers).extract(pth), filetype)
+
+
+def list_archive(filename):
+    """Return the names of the members of the archive `filename`
+
+    Member names are as stored in the archive (eg: with a trailing slash for
+    the directories of zip files). Nothing is written to disk.
+    """
+    assert path.isfile(filename), 'not a file: %s' % filename
+    filetype, implementor = _archive_implementor(filename)
+    return implementor(filename).list()
+
+
+def extract_members(filename, patterns, dest='.'):
+    """Extract the members of the archive `filename` matching `patterns`
+
+    `patterns` are member names (or glob patterns) as returned by
+    ``list_archive``; the members are extracted under `dest` with their
+    archive path, without any toplevel directory handling. When all
+    `patterns` are plain names, tarballs are read only until all of them
+    are found. The target of a hard link in a tarball must be extracted as
+    well, so must match `patterns` too.
+
+    Return the paths of the extracted members.
+    """
+    assert path.isfile(filename), 'not a file: %s' % filename
+    assert path.isdir(dest)
+    filetype, implementor = _archive_implementor(filename)
+    return implementor(filename).extract_members(patterns, dest)
+
+
+def verify_archive(filename, single_toplevel=False):
+    """Check the integrity of the archive `filename` without extracting it
+
+    All the data is decompressed and checked against the archive's CRCs or
+    checksums; member headers must be valid, no member may end up outside of
+    the extraction directory, and the archive must unpack to a single
+    directory as ``unpack_archive`` does it (with `single_toplevel`, it must
+    already have a single toplevel directory).
+
+    Plain tar files have no checksum for the data (only for the headers),
+    and neither have zstd frames written without one (``pack_archive``
+    writes it): only the header, path and layout checks apply to those, so
+    passing them is no proof that the data is intact.
+
+    Raise PackError (or a subclass) for the first problem found; return the
+    filetype.
+    """
+    assert path.isfile(filename), 'not a file: %s' % filename
+    filetype, implementor = _archive_implementor(filename)
+    implementor(filename).verify(single_toplevel)
+    return filetype
+
+
+def verify_archives(filenames, max_workers=None, single_toplevel=False):
+    """Verify the given archives (see ``verify_archive``) concurrently
+
+    The archives are verified in a pool of at most `max_workers` processes
+    (by default, as many as ``concurrent.futures.ProcessPoolExecutor``
+    picks).
+
+    Return a dict mapping each filename to its PackError, or None if it is
+    valid.
+    """
+    filenames = list(filenames)
+    if max_workers == 1 or futures is None:
+        return dict((filename, _verify_archive(filename, single_toplevel))
+                    for filename in filenames)
+    with futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(filenames, executor.map(
+            _verify_archive, filenames, [single_toplevel] * len(filenames))))
+
+
+def _verify_archive(filename, single_toplevel):
+    try:
+        verify_archive(filename, single_toplevel)
+    except PackError as e:
+        return e
+
+
+def _archive_implementor(filename):
+    """Return (filetype, implementor) for the archive `filename`"""
+    from applib import _compression
+
+    format = _compression.sniff(filename)
+    if format is None:
         raise PackError('unknown compression format: ' + filename)
+    if format not in _compression.formats:
+        raise PackError('unsupported compression format ({0}): {1}'.format(
+            format, filename))
+    filetype = _compression.formats[format]
+    return filetype, _compression.implementors[filetype]
 
 
-def pack_archive(filename, files, pwd, filetype="tgz"):
+def pack_archive(filename, files, pwd, filetype="tgz", workers=1):
     """Pack the given `files` from directory `pwd`
+
+    Relative `files` and `filename` are relative to `pwd`; the working
+    directory is not changed (see ``unpack_archive``).
     
-    `filetype` must be one of ["tgz", "tbz2", "zip"]
+    `filetype` must be one of ["tgz", "bz2", "txz", "tzst", "tar", "zip"]
+
+    The archive is compressed by `workers` threads (None for as many as
+    ``concurrent.futures`` sees fit).
     """
     from applib import _compression
     
     assert path.isdir(pwd)
     assert filetype in _compression.implementors, 'invalid filetype: %s' % filetype
     
-    if path.exists(filename):
-        rm(filename)
+    archive = path.join(pwd, filename)
+    if path.exists(archive):
+        rm(archive)
     
-    with cd(pwd):
-        relnames = [path.relpath(file, pwd) for file in files]
-        _compression.implementors[filetype].pack(relnames, filename)
+    relnames = [path.relpath(path.join(pwd, file), pwd) for file in files]
+    _compression.implementors[filetype].pack(
+        relnames, archive, pwd, workers=workers)
         
     return filename
         
@@ -71,14 +193,30 @@ def mkdirs(pth):
         assert path.isdir(pth)
     
     
-def rm(p):
+def rm(p, workers=1, background=False):
     """Remove the specified path recursively. Similar to `rm -rf ARG`
     
     Note: if ARG is a symlink, only that symlink will be removed.
+
+    Files in a directory tree are deleted using `workers` threads (None for as
+    many as ``concurrent.futures`` sees fit).
+
+    If `background` is True, a directory is renamed out of the way (to a
+    hidden sibling) and deleted by a background thread, which is returned;
+    the interpreter waits for it to finish before exiting.
     """
     if path.lexists(p):
         if path.isdir(p) and not path.islink(p):
-            shutil.rmtree(p)
+            if background:
+                parent, name = path.split(path.normpath(p))
+                trash = path.join(parent, '.{0}.rm-{1}'.format(
+                    name, binascii.hexlify(os.urandom(4)).decode('ascii')))
+                os.rename(p, trash)
+                t = threading.Thread(target=_rmtree, args=(trash, workers),
+                                     name='rm ' + trash)
+                t.start()
+                return t
+            _rmtree(p, workers)
         else:
             os.remove(p)
 
@@ -90,37 +228,151 @@ def mv(src, dest, _mkdirs=False):
     shutil.move(src, dest)
     
 
-def cp(src, dest, _mkdirs=False, ignore=None, copyperms=True):
-    """Copy `src` to `dest` recursively"""
+def cp(src, dest, _mkdirs=False, ignore=None, copyperms=True, workers=1,
+       mode='copy'):
+    """Copy `src` to `dest` recursively
+
+    Files in a directory tree are copied using `workers` threads (None for
+    as many as ``concurrent.futures`` sees fit).
+
+    `mode` determines how files are copied:
+
+     - 'copy':     copy their data
+     - 'reflink':  make copy-on-write clones sharing the data (Linux; supported
+                   by btrfs, XFS and a few others)
+     - 'hardlink': create hard links; the "copies" are then the same files,
+                   which had better not be modified
+     - 'auto':     try 'reflink', then 'hardlink' and fall back to 'copy'
+     - 'reflink-or-copy': try 'reflink' and fall back to 'copy'; unlike
+                   'auto', the copies can always be modified independently
+    """
     assert path.exists(src)
+    assert mode in _COPY_MODES, 'invalid mode: %s' % mode
     
     if _mkdirs:
         mkdirs(path.dirname(dest))
     
     if path.isdir(src):
-        _copytree(src, dest, ignore=ignore, copyperms=copyperms)
+        _copytree(src, dest, ignore=ignore, copyperms=copyperms,
+                  workers=workers, mode=mode)
     else:
-        shutil.copyfile(src, dest)
+        _copyfile(src, dest, mode)
+
+
+def find(pth, pattern, index=None):
+    """Find files or directories matching ``pattern`` under ``pth``
+
+    See ``iterfind`` for `index`.
+    """
+    return list(iterfind(pth, pattern, index=index))
+
 
+def iterfind(pth, patterns, exclude=None, types=None, index=None):
+    """Yield files or directories matching ``patterns`` under ``pth``
 
-def find(pth, pattern):
-    """Find files or directories matching ``pattern`` under ``pth``"""
-    matches = []
+    The tree is walked lazily, and matching paths are yielded directory by
+    directory.
+
+    - patterns: glob pattern, or list of patterns, matched against file names
+    - exclude:  glob pattern(s) of names to skip; matching directories are not
+                descended into
+    - types:    only yield these types of files; any of 'f' (regular file),
+                'd' (directory) and 'l' (symlink). Eg: 'fl'
+    - index:    a persistent ``FileIndex`` of ``pth`` to answer the query
+                from, after refreshing it (in which case results are not in
+                the order of a walk). See ``FileIndex``.
+    """
+    if index is not None:
+        assert path.samefile(index.root, pth), \
+            'index is for %s, not %s' % (index.root, pth)
+        index.refresh()
+        for found in index.iterfind(patterns, exclude, types, root=pth):
+            yield found
+        return
+
+    match = _compile_patterns(patterns)
+    excluded = _compile_patterns(exclude) if exclude else None
     if path.isfile(pth):
-        if fnmatch(path.basename(pth), pattern):
-            matches.append(pth)
-    else:
-        for root, dirs, files in os.walk(pth):
-            matches.extend([
-                path.join(root, f) for f in files+dirs
-                if fnmatch(f, pattern)
-            ])
-    return matches
+        if match(path.basename(pth)) and _type_matches(_file_type(pth), types):
+            yield pth
+        return
+    for found in _iterfind(pth, match, excluded, types):
+        yield found
+
+
+def _iterfind(root, match, excluded, types):
+    """Walk ``root`` for ``iterfind``, in the same order as os.walk does"""
+    try:
+        entries = list(scandir(root))
+    except OSError:
+        return  # like os.walk, ignore directories that cannot be listed
+
+    files, dirs = [], []
+    for entry in entries:
+        if excluded and excluded(entry.name):
+            continue
+        (dirs if entry.is_dir() else files).append(entry)
+
+    for entry in files + dirs:
+        if match(entry.name) and _type_matches(_entry_type(entry), types):
+            yield entry.path
+
+    for entry in dirs:
+        if not entry.is_symlink():
+            for found in _iterfind(entry.path, match, excluded, types):
+                yield found
+
+
+def _compile_patterns(patterns):
+    """Compile glob pattern(s) into a single regex; return its match method"""
+    if isinstance(patterns, six.string_types):
+        patterns = [patterns]
+    regexes = []
+    for pattern in patterns:
+        regex = fnmatch_translate(pattern)
+        if regex.endswith('(?ms)'):
+            regex = regex[:-len('(?ms)')]  # Python < 3.6
+        regexes.append('(?:{0})'.format(regex))
+    flags = re.S | re.M
+    if path.normcase('A') == 'a':
+        flags |= re.I  # like fnmatch, ignore case on Windows
+    return re.compile('|'.join(regexes), flags).match
+
+
+def _type_matches(file_type, types):
+    """Return True if `file_type` is one of the ``iterfind`` `types`"""
+    return types is None or (file_type is not None and file_type in types)
+
+
+def _entry_type(entry):
+    """Return the ``iterfind`` type of the DirEntry `entry`"""
+    if entry.is_symlink():
+        return 'l'
+    elif entry.is_dir(follow_symlinks=False):
+        return 'd'
+    elif entry.is_file(follow_symlinks=False):
+        return 'f'
+    return None
+
+
+def _file_type(pth):
+    """Return the ``iterfind`` type of `pth`"""
+    if path.islink(pth):
+        return 'l'
+    elif path.isdir(pth):
+        return 'd'
+    elif path.isfile(pth):
+        return 'f'
+    return None
     
     
 @contextmanager
 def cd(pth):
-    """With context to temporarily change directory"""
+    """With context to temporarily change directory
+
+    As the working directory is process-wide, this affects all threads; prefer
+    passing explicit paths (eg: `cwd` to ``run``) in multi-threaded code.
+    """
     assert path.isdir(existing(pth)), pth
     
     cwd = os.getcwd()
@@ -132,14 +384,18 @@ def cd(pth):
 
 
 @contextmanager
-def tmpdir(prefix='tmp-', suffix=''):
+def tmpdir(prefix='tmp-', suffix='', chdir=True):
     """__with__ context to work in a temporary working directory
     
     Temporary directory will be deleted unless an exception was raised. During
-    the context, CWD will be changed to the temporary directory.
+    the context, CWD will be changed to the temporary directory (unless
+    `chdir` is False, which is safe to use from multiple threads).
     """
     d = tempfile.mkdtemp(prefix=prefix, suffix=suffix)
-    with cd(d):
+    if chdir:
+        with cd(d):
+            yield d
+    else:
         yield d
     rm(d)
 
@@ -151,49 +407,253 @@ def existing(pth):
     return pth
     
     
-def _copytree(src, dst, symlinks=False, ignore=None, copyperms=True):
-    """Forked shutil.copytree for `copyperms` support"""
-    names = os.listdir(src)
-    if ignore is not None:
-        ignored_names = ignore(src, names)
-    else:
-        ignored_names = set()
+def _rmtree(pth, workers=1):
+    """shutil.rmtree with the files deleted by `workers` threads
+
+    The tree is walked in the calling thread; each directory's files are
+    unlinked (relative to the directory's fd where supported) in the thread
+    pool, and the directories are removed, deepest first, at the end.
+    """
+    if workers == 1 or futures is None:
+        # on Python 3, this too uses scandir and fd-relative unlinks
+        shutil.rmtree(pth)
+        return
+
+    dirs = []
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = []
+
+        def walk(dirpath):
+            names = []
+            for entry in scandir(dirpath):
+                if entry.is_dir(follow_symlinks=False):
+                    walk(entry.path)
+                else:
+                    names.append(entry.name)
+            if names:
+                pending.append(executor.submit(_unlink_all, dirpath, names))
+            dirs.append(dirpath)
 
-    os.makedirs(dst)
-    errors = []
-    for name in names:
-        if name in ignored_names:
-            continue
-        srcname = os.path.join(src, name)
-        dstname = os.path.join(dst, name)
         try:
-            if symlinks and os.path.islink(srcname):
-                linkto = os.readlink(srcname)
-                os.symlink(linkto, dstname)
-            elif os.path.isdir(srcname):
-                _copytree(srcname, dstname, symlinks, ignore, copyperms)
+            walk(pth)
+            for future in pending:
+                future.result()  # raise the error, if any
+        finally:
+            for future in pending:
+                future.cancel()
+
+    for dirpath in dirs:
+        os.rmdir(dirpath)
+
+
+def _unlink_all(dirpath, names):
+    """Unlink the files `names` in the directory `dirpath`"""
+    if not _UNLINK_DIR_FD:
+        for name in names:
+            os.unlink(path.join(dirpath, name))
+        return
+
+    fd = os.open(dirpath, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+    try:
+        for name in names:
+            os.unlink(name, dir_fd=fd)
+    finally:
+        os.close(fd)
+
+
+_UNLINK_DIR_FD = os.unlink in getattr(os, 'supports_dir_fd', ()) and \
+    hasattr(os, 'O_DIRECTORY') and hasattr(os, 'O_NOFOLLOW')
+
+
+def _copytree(src, dst, symlinks=False, ignore=None, copyperms=True,
+              workers=1, mode='copy'):
+    """Forked shutil.copytree for `copyperms` and `workers` support
+
+    The tree is walked (and directories created) in the calling thread, while
+    files are copied in a pool of `workers` threads as they are found.
+    """
+    executor = None
+    if workers != 1 and futures is not None:
+        executor = futures.ThreadPoolExecutor(max_workers=workers)
+    pending = []
+    copied_dirs = []
+
+    def copy(srcname, dstname):
+        if executor is None:
+            _copy(srcname, dstname, mode)
+        else:
+            pending.append(executor.submit(_copy, srcname, dstname, mode))
+
+    def walk(src, dst):
+        entries = list(scandir(src))
+        if ignore is not None:
+            ignored_names = ignore(src, [e.name for e in entries])
+        else:
+            ignored_names = set()
+
+        os.makedirs(dst)
+        for entry in entries:
+            if entry.name in ignored_names:
+                continue
+            dstname = os.path.join(dst, entry.name)
+            if symlinks and entry.is_symlink():
+                os.symlink(os.readlink(entry.path), dstname)
+            elif entry.is_dir():
+                walk(entry.path, dstname)
             else:
-                shutil.copy(srcname, dstname)
+                copy(entry.path, dstname)
             # XXX What about devices, sockets etc.?
-        except (IOError, os.error) as why:
-            raise
-            errors.append((srcname, dstname, str(why)))
-        # catch the Error from the recursive copytree so that we can
-        # continue with other files
-        except shutil.Error:
-            _, err = sys.exec_info()
-            errors.extend(err.args[0])
+        copied_dirs.append((src, dst))
+
+    try:
+        walk(src, dst)
+        for future in pending:
+            future.result()  # raise the error, if any
+    finally:
+        if executor is not None:
+            for future in pending:
+                future.cancel()
+            executor.shutdown()
+
     if copyperms:
+        # deepest directories first, after all their contents are in place
+        for src, dst in copied_dirs:
+            try:
+                shutil.copystat(src, dst)
+            except WindowsError:
+                # can't copy file access times on Windows
+                pass
+
+
+def _copy(src, dst, mode='copy'):
+    """Same as shutil.copy (for files), but using ``_copyfile``"""
+    if _copyfile(src, dst, mode) != 'hardlink':
+        shutil.copymode(src, dst)
+
+
+def _copyfile(src, dst, mode='copy'):
+    """Copy the contents of file `src` to `dst`, as per `mode` (see ``cp``)
+
+    When copying data, it is done in the kernel, without passing through user
+    space, using copy_file_range(2) or sendfile(2) where available.
+
+    Return the mode actually used.
+    """
+    if _samefile(src, dst):
+        # writing to (or replacing) `dst` would truncate (or remove) `src`
+        raise _SameFileError('{0} and {1} are the same file'.format(src, dst))
+    if mode in ('reflink', 'auto', 'reflink-or-copy'):
+        if _reflink(src, dst, strict=mode == 'reflink'):
+            return 'reflink'
+    if mode in ('hardlink', 'auto'):
+        if path.lexists(dst):
+            os.remove(dst)
         try:
-            shutil.copystat(src, dst)
-        except WindowsError:
-            # can't copy file access times on Windows
-            pass
-        except OSError:
-            _, why = sys.exec_info()
-            errors.extend((src, dst, str(why)))
-    if errors:
-        raise shutil.Error(errors)
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError as e:
+            if mode == 'hardlink' or e.errno not in _LINK_UNSUPPORTED:
+                raise
+
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            for kernel_copy in _KERNEL_COPIERS:
+                if _kernel_copyfile(kernel_copy, fsrc.fileno(), fdst.fileno()):
+                    return 'copy'
+            shutil.copyfileobj(fsrc, fdst, _COPY_CHUNK_SIZE)
+    return 'copy'
+
+
+def _samefile(src, dst):
+    """Return True if `src` and `dst` are the same file (or hardlinks)"""
+    if not hasattr(path, 'samefile'):  # Windows, on Python 2
+        return path.normcase(path.abspath(src)) == \
+            path.normcase(path.abspath(dst))
+    try:
+        return path.samefile(src, dst)
+    except OSError:
+        return False
+
+
+# raised by shutil.copyfile in the same case (shutil.Error on Python 2)
+_SameFileError = getattr(shutil, 'SameFileError', shutil.Error)
+
+
+def _reflink(src, dst, strict):
+    """Make `dst` a copy-on-write clone of `src` using the FICLONE ioctl
+
+    Return False if that is not possible, or raise the error if `strict`.
+    """
+    if not sys.platform.startswith('linux'):
+        if strict:
+            raise OSError(errno.EOPNOTSUPP, 'reflinks are not supported on '
+                          'this platform', src)
+        return False
+
+    import fcntl
+    FICLONE = 0x40049409  # _IOW(0x94, 9, int) from linux/fs.h
+    if path.lexists(dst):
+        os.remove(dst)  # never write through an existing link to `dst`
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return True
+            except (IOError, OSError) as e:
+                if strict or e.errno not in _REFLINK_UNSUPPORTED:
+                    raise
+                return False
+
+
+_COPY_MODES = ('copy', 'reflink', 'hardlink', 'auto', 'reflink-or-copy')
+
+_COPY_CHUNK_SIZE = 1024*1024
+
+_KERNEL_COPIERS = []
+if hasattr(os, 'copy_file_range'):
+    # uses (and advances) the file offsets of both descriptors
+    _KERNEL_COPIERS.append(
+        lambda infd, outfd, offset: os.copy_file_range(
+            infd, outfd, _COPY_CHUNK_SIZE))
+if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+    _KERNEL_COPIERS.append(
+        lambda infd, outfd, offset: os.sendfile(
+            outfd, infd, offset, _COPY_CHUNK_SIZE))
+
+# errors meaning that a kernel copy function cannot be used for these files
+_KERNEL_COPY_UNSUPPORTED = set(getattr(errno, name) for name in [
+    'ENOSYS', 'EXDEV', 'EINVAL', 'EOPNOTSUPP', 'ENOTSUP', 'ENOTSOCK', 'EPERM',
+    'EBADF'] if hasattr(errno, name))
+
+
+# errors meaning that files cannot be reflinked/hardlinked (eg: crossing
+# filesystems, unsupporting filesystem, too many links)
+_REFLINK_UNSUPPORTED = _KERNEL_COPY_UNSUPPORTED | set(getattr(errno, name)
+    for name in ['ENOTTY', 'ETXTBSY'] if hasattr(errno, name))
+_LINK_UNSUPPORTED = _KERNEL_COPY_UNSUPPORTED | set(getattr(errno, name)
+    for name in ['EMLINK', 'EACCES'] if hasattr(errno, name))
+
+
+def _kernel_copyfile(kernel_copy, infd, outfd):
+    """Copy all data from `infd` to `outfd` using `kernel_copy`
+
+    Return False if `kernel_copy` is not supported for these files (which is
+    only found out on the first call, before anything is copied).
+    """
+    offset = 0
+    while True:
+        try:
+            copied = kernel_copy(infd, outfd, offset)
+        except OSError as e:
+            if offset == 0 and e.errno in _KERNEL_COPY_UNSUPPORTED:
+                return False
+            raise
+        if copied == 0:
+            if offset == 0 and os.fstat(infd).st_size > 0:
+                # eg: files in /proc claim to be empty
+                return False
+            return True
+        offset += copied
     
 
 # WindowsError is not available on other platforms
@@ -201,3 +661,8 @@ try:
     WindowsError
 except NameError:
     class WindowsError(OSError): pass
+
+
+# at the end, as these modules use this one (importing it lazily)
+from applib._findindex import *
+from applib._extractcache import *
@@ -5,6 +5,8 @@ import os
 from os import path
 import tempfile
 import sys
+import shutil
+import signal
 
 import pytest
 
@@ -86,6 +88,26 @@ def test_sh_rm_dir():
         assert not path.exists('adir')
  
 
+def test_sh_rm_dir_parallel():
+    with sh.tmpdir():
+        for d in ['adir/a/b', 'adir/c']:
+            sh.mkdirs(d)
+            for n in range(10):
+                with open(path.join(d, str(n)), 'w') as f: f.close()
+        sh.rm('adir', workers=4)
+        assert not path.exists('adir')
+
+
+def test_sh_rm_dir_background():
+    with sh.tmpdir():
+        sh.mkdirs('adir/a')
+        with open('adir/a/afile', 'w') as f: f.close()
+        t = sh.rm('adir', background=True)
+        assert not path.exists('adir')
+        t.join()
+        assert os.listdir('.') == []
+
+
 # Workaround a py.test bug:
 # Error evaluating 'skipif' expression
 #     b'sys.platform == "win32"'
@@ -132,6 +154,252 @@ def test_sh_rm_symlink_dir():
         assert not path.lexists('alink')
         
         
+def test_sh_cp_tree():
+    with sh.tmpdir():
+        for d in ['src/a/b', 'src/c']:
+            sh.mkdirs(d)
+        for f in ['src/x', 'src/a/y', 'src/a/b/z', 'src/c/ignored.pyc']:
+            with open(f, 'w') as fil:
+                fil.write(f * 1000)
+        os.chmod('src/a/y', 0o700)
+
+        for workers in [1, 4]:
+            dest = 'dest{0}'.format(workers)
+            sh.cp('src', dest, workers=workers,
+                  ignore=lambda d, names: [n for n in names
+                                           if n.endswith('.pyc')])
+            assert sorted(sh.find(dest, '*')) == sorted([
+                path.join(dest, p) for p in ['x', 'a', 'a/y', 'a/b', 'a/b/z',
+                                             'c']])
+            with open(path.join(dest, 'a/b/z')) as fil:
+                assert fil.read() == 'src/a/b/z' * 1000
+            if sys.platform != 'win32':
+                assert os.stat(path.join(dest, 'a/y')).st_mode & 0o777 == 0o700
+
+        # never truncate the source by copying it onto itself
+        with pytest.raises(shutil.Error):
+            sh.cp('src/x', 'src/x')
+        with open('src/x') as fil:
+            assert fil.read() == 'src/x' * 1000
+
+
+def test_sh_iterfind():
+    with sh.tmpdir():
+        for d in ['a/.git/objects', 'b']:
+            sh.mkdirs(d)
+        for f in ['a/x.py', 'a/y.c', 'a/.git/objects/z.py', 'b/w.txt']:
+            with open(f, 'w') as fil: fil.close()
+
+        assert sorted(sh.iterfind('.', ['*.py', '*.c'], exclude='.git')) == [
+            path.join('.', 'a', 'x.py'), path.join('.', 'a', 'y.c')]
+        assert sorted(sh.iterfind('.', '*', types='d')) == [
+            path.join('.', 'a'), path.join('.', 'a', '.git'),
+            path.join('.', 'a', '.git', 'objects'), path.join('.', 'b')]
+        assert sh.find(path.join('b', 'w.txt'), '*.txt') == [
+            path.join('b', 'w.txt')]
+
+
+def test_sh_find_index():
+    with sh.tmpdir() as d:
+        sh.mkdirs('tree/a/.git')
+        for f in ['tree/x.py', 'tree/a/y.py', 'tree/a/.git/z.py']:
+            with open(f, 'w') as fil: fil.close()
+
+        index = sh.FileIndex('tree', path.join(d, 'cache'))
+        assert isinstance(index, sh.FileIndex)
+        assert hasattr(sh.FileIndex, 'for_application')
+        assert sorted(sh.find('tree', '*.py', index=index)) == sorted(
+            sh.find('tree', '*.py'))
+        assert sorted(sh.iterfind('tree', '*.py', exclude='.git',
+                                  index=index)) == [
+            path.join('tree', 'a', 'y.py'), path.join('tree', 'x.py')]
+
+        # changes are picked up by the refresh
+        sh.rm('tree/a/.git')
+        sh.mkdirs('tree/b')
+        with open('tree/b/w.py', 'w') as fil: fil.close()
+        assert sorted(sh.find('tree', '*.py', index=index)) == [
+            path.join('tree', 'a', 'y.py'), path.join('tree', 'b', 'w.py'),
+            path.join('tree', 'x.py')]
+        index.close()
+
+
+@skipif('sys.platform == "win32"')
+def test_sh_cp_modes():
+    with sh.tmpdir():
+        sh.mkdirs('src/a')
+        with open('src/a/x', 'w') as fil:
+            fil.write('x')
+
+        sh.cp('src', 'hardlinked', mode='hardlink')
+        assert path.samefile('src/a/x', 'hardlinked/a/x')
+
+        sh.cp('src', 'auto', mode='auto')
+        with open('auto/a/x') as fil:
+            assert fil.read() == 'x'
+
+        sh.cp('src/a/x', 'copied', mode='copy')
+        assert not path.samefile('src/a/x', 'copied')
+
+        # a hardlink to the source is not written through (nor replaced)
+        for mode in ['copy', 'reflink', 'hardlink', 'auto']:
+            with pytest.raises(shutil.Error):
+                sh.cp('src/a/x', 'hardlinked/a/x', mode=mode)
+        with open('src/a/x') as fil:
+            assert fil.read() == 'x'
+
+
+@skipif('sys.platform == "win32"')
+def test_sh_iterrun():
+    output = list(sh.iterrun('echo a; echo b 1>&2; printf "c\nd"', lines=True))
+    assert [d for (s, d) in output if s == 'stdout'] == [b'a\n', b'c\n', b'd']
+    assert [d for (s, d) in output if s == 'stderr'] == [b'b\n']
+
+    # a carriage return does not end a line, wherever the chunks end
+    output = list(sh.iterrun('printf "a\rb\nc\r"; sleep 0.1; printf "\nd"',
+                             lines=True))
+    assert [d for (s, d) in output] == [b'a\rb\n', b'c\r\n', b'd']
+
+    with pytest.raises(sh.RunNonZeroReturn):
+        for stream, data in sh.iterrun('echo a; exit 1'):
+            assert (stream, data) == ('stdout', b'a\n')
+
+    with pytest.raises(sh.RunTimedout):
+        list(sh.iterrun('sleep 5', timeout=0.2))
+
+
+@skipif('sys.platform == "win32"')
+def test_sh_run_timeout_escalation():
+    import time
+    # this used to poll in 100ms steps, so took at least 1s
+    t = time.time()
+    for _ in range(10):
+        sh.run('true', timeout=10)
+    assert time.time() - t < 1
+
+    with pytest.raises(sh.RunTimedout) as excinfo:
+        sh.run(['sh', '-c', 'trap "" TERM; sleep 5'], timeout=0.2, grace=0.2,
+               process_group=True)
+    assert len(excinfo.value.actions) == 2
+    assert 'SIGKILL' in str(excinfo.value)
+    assert excinfo.value.result.signal == signal.SIGKILL
+
+    # without grace, a process ignoring SIGTERM is left alone
+    with pytest.raises(sh.RunTimedout) as excinfo:
+        sh.run(['sh', '-c', 'trap "" TERM; sleep 5'], timeout=0.2)
+    assert excinfo.value.result.returncode is None
+    assert 'left running' in excinfo.value.actions[-1]
+    pid = int(excinfo.value.actions[0].rsplit(' ', 1)[1])
+    os.kill(pid, signal.SIGKILL)
+
+    with pytest.raises(sh.RunTimedout) as excinfo:
+        sh.run(['sleep', '5'], timeout=0.2)
+    assert excinfo.value.result.signal == signal.SIGTERM
+
+
+def test_sh_run_capture():
+    cmd = 'python -c "print(\'x\' * 100000)"'
+    stdout, stderr = sh.run(cmd, spool_size=1000)
+    assert stdout.strip() == b'x' * 100000
+
+    stdout, stderr = sh.run(cmd, max_capture=100)
+    head, omitted, tail = stdout.split(b'\n', 2)
+    assert head == b'x' * 50
+    assert omitted == b'[... 99901 bytes omitted ...]'
+    assert tail == b'x' * 49 + b'\n'
+
+
+@skipif('sys.platform == "win32"')
+def test_sh_run_background_child():
+    # the pipes are inherited by `sleep`, but the shell exits right away; if
+    # the output was read till they are closed, this would time out
+    stdout, stderr = sh.run('sleep 30 & echo hi', timeout=10)
+    assert stdout == b'hi\n'
+
+
+def test_sh_run_result():
+    result = sh.run('python -c "print(42)"', result=True)
+    stdout, stderr = result
+    assert stdout.strip() == b'42'
+    assert result.returncode == 0 and result.signal is None
+    assert result.stdout_size == len(stdout)
+    assert result.wall_time > 0
+    if hasattr(os, 'wait4'):
+        assert result.user_time + result.system_time > 0
+        assert result.max_rss > 0
+
+    with pytest.raises(sh.RunNonZeroReturn) as excinfo:
+        sh.run('python -c "raise SystemExit(3)"')
+    assert excinfo.value.result.returncode == 3
+
+
+@skipif('sys.platform == "win32"')
+def test_sh_run_limits():
+    cmd = ['python', '-c', 'import os, resource; print(os.nice(0), '
+           'resource.getrlimit(resource.RLIMIT_NOFILE)[0])']
+    stdout, _ = sh.run(cmd, limits={'nofile': 64}, nice=1)
+    assert int(stdout.split()[1]) == 64
+    assert int(stdout.split()[0]) == os.nice(0) + 1
+
+    # applied from the parent (where possible), safely with threads
+    for stdout, _ in sh.run_many([cmd] * 4, max_workers=4,
+                                 limits={'nofile': 64}):
+        assert int(stdout.split()[1]) == 64
+
+    with pytest.raises(sh.RunLimitExceeded) as excinfo:
+        sh.run(['python', '-c', 'while True: pass'], limits={'cpu': 1})
+    assert excinfo.value.limit == 'cpu'
+
+    with pytest.raises(ValueError):
+        sh.run('true', limits={'nosuchlimit': 1})
+
+
+def test_sh_run_cwd():
+    cwd = os.getcwd()
+    with sh.tmpdir(chdir=False) as d:
+        assert os.getcwd() == cwd
+        stdout, _ = sh.run('python -c "import os; print(os.getcwd())"', cwd=d)
+        assert path.samefile(stdout.strip().decode('utf-8'), d)
+    assert not path.exists(d)
+
+
+def test_sh_run_many():
+    cmds = ['echo {0}'.format(i) for i in range(10)]
+    results = sh.run_many(cmds, max_workers=4)
+    assert [out.strip() for (out, err) in results] == [
+        str(i).encode() for i in range(10)]
+
+    with pytest.raises(sh.RunManyError) as excinfo:
+        sh.run_many(['echo a', 'exit 1', 'echo c'], max_workers=2)
+    assert list(excinfo.value.errors) == [1]
+    assert isinstance(excinfo.value.errors[1], sh.RunNonZeroReturn)
+    assert excinfo.value.results[1] is None
+    assert excinfo.value.results[2][0].strip() == b'c'
+
+    with pytest.raises(sh.RunNonZeroReturn):
+        sh.run_many(['exit 1', 'echo b'], fail_fast=True)
+
+
+@skipif('sys.platform == "win32" or sys.version_info[:2] < (3, 7)')
+def test_sh_arun():
+    import asyncio
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        results = loop.run_until_complete(asyncio.wait_for(asyncio.gather(
+            *[sh.arun('sleep 0.2; echo {0}'.format(i)) for i in range(20)]), 2))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+    assert results[3] == (b'3\n', b'')
+
+    with pytest.raises(sh.RunNonZeroReturn):
+        asyncio.run(sh.arun(['sh', '-c', 'exit 1']))
+    with pytest.raises(sh.RunTimedout):
+        asyncio.run(sh.arun(['sleep', '5'], timeout=0.2))
+
+
 def test_console_width_detection():
     width = textui.find_console_width()
     assert width is None
@@ -181,6 +449,510 @@ def test_compression_catch_invalid_mode():
         extract()
     
     
+def test_compression_tar_multiple_toplevels():
+    """Archives with several toplevels are extracted into a new directory"""
+    from applib import _compression
+    testdir = tempfile.mkdtemp('-test', 'applib-')
+    src = path.join(testdir, 'src')
+    for name in ('a/x.txt', 'a/sub/y.txt', 'b.txt'):
+        sh.mkdirs(path.dirname(path.join(src, name)) or src)
+        with open(path.join(src, name), 'w') as f:
+            f.write(name)
+    tgz = path.join(testdir, 'multi-1.0.tar.gz')
+    _compression.GzipTarredFile.pack(['a', 'b.txt'], tgz, src)
+    assert _compression.GzipTarredFile.is_valid(tgz)
+    assert not _compression.Bzip2TarredFile.is_valid(tgz)
+
+    out = path.join(testdir, 'out')
+    sh.mkdirs(out)
+    extracted_dir, _ = sh.unpack_archive(tgz, out)
+    assert extracted_dir == path.abspath(path.join(out, 'multi-1.0'))
+    assert os.listdir(out) == ['multi-1.0']
+    with open(path.join(extracted_dir, 'a', 'sub', 'y.txt')) as f:
+        assert f.read() == 'a/sub/y.txt'
+    assert path.isfile(path.join(extracted_dir, 'b.txt'))
+
+    # the first toplevel may have the name of the new directory
+    sh.mkdirs(path.join(src, 'named-1.0'))
+    with open(path.join(src, 'PKG-INFO'), 'w') as f:
+        f.write('')
+    tgz = path.join(testdir, 'named-1.0.tar.gz')
+    _compression.GzipTarredFile.pack(['named-1.0', 'PKG-INFO'], tgz, src)
+    out = path.join(testdir, 'out2')
+    sh.mkdirs(out)
+    extracted_dir, _ = sh.unpack_archive(tgz, out)
+    assert os.listdir(out) == ['named-1.0']
+    assert sorted(os.listdir(extracted_dir)) == ['PKG-INFO', 'named-1.0']
+    sh.rm(testdir)
+
+
+def test_compression_sniff():
+    import zipfile
+    from applib import _compression
+    testdir = tempfile.mkdtemp('-test', 'applib-')
+    src = path.join(testdir, 'pkg-1.0')
+    sh.mkdirs(src)
+    with open(path.join(src, 'README'), 'w') as f:
+        f.write('hello')
+    for filetype, format in [('tgz', 'gzip'), ('bz2', 'bzip2'),
+                             ('tar', 'tar')]:
+        archive = path.join(testdir, 'pkg-1.0.' + filetype)
+        sh.pack_archive(archive, ['pkg-1.0'], testdir, filetype)
+        assert _compression.sniff(archive) == format
+        out = tempfile.mkdtemp(dir=testdir)
+        assert sh.unpack_archive(archive, out) == (
+            path.abspath(path.join(out, 'pkg-1.0')), filetype)
+
+    # a relative filename is relative to pwd, including for the removal of
+    # a previous archive
+    with sh.tmpdir():
+        with open('pkg-1.0.tgz', 'w') as f:
+            f.write('unrelated')
+        for _ in range(2):
+            sh.pack_archive('pkg-1.0.tgz', ['pkg-1.0'], testdir)
+        assert path.exists('pkg-1.0.tgz')
+        assert _compression.sniff(path.join(testdir, 'pkg-1.0.tgz')) == 'gzip'
+
+    # zip files with leading data are found by their central directory
+    sfx = path.join(testdir, 'sfx.zip')
+    with open(sfx, 'wb') as f:
+        f.write(b'#!/bin/sh\n' * 100)
+    with zipfile.ZipFile(sfx, 'a') as f:
+        f.writestr('pkg-1.0/README', 'hello')
+    assert _compression.sniff(sfx) == 'zip'
+
+    junk = path.join(testdir, 'junk')
+    with open(junk, 'wb') as f:
+        f.write(b'\xfd7zXZ\x00' + b'\x00' * 100)
+    assert _compression.sniff(junk) == 'xz'
+    with open(junk, 'wb') as f:
+        f.write(b'not an archive')
+    assert _compression.sniff(junk) is None
+    with pytest.raises(sh.PackError):
+        sh.unpack_archive(junk, testdir)
+    sh.rm(testdir)
+
+
+def test_compression_zip_parallel():
+    import zipfile
+    testdir = tempfile.mkdtemp('-test', 'applib-')
+    archive = path.join(testdir, 'bundle-2.0.zip')
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as f:
+        f.writestr('top/', '')
+        for i in range(200):
+            f.writestr('top/d{0}/e{1}/f{2}.txt'.format(i % 7, i % 3, i),
+                       'data {0}\n'.format(i) * (i * 10))
+        f.writestr('other.txt', 'not under top')
+
+    out = path.join(testdir, 'out')
+    sh.mkdirs(out)
+    extracted_dir, filetype = sh.unpack_archive(archive, out, workers=4)
+    assert filetype == 'zip'
+    assert extracted_dir == path.abspath(path.join(out, 'bundle-2.0'))
+    for i in range(200):
+        name = path.join(extracted_dir, 'top', 'd{0}'.format(i % 7),
+                         'e{0}'.format(i % 3), 'f{0}.txt'.format(i))
+        with open(name) as f:
+            assert f.read() == 'data {0}\n'.format(i) * (i * 10)
+    assert path.isfile(path.join(extracted_dir, 'other.txt'))
+    sh.rm(testdir)
+
+
+def test_compression_zip_pack():
+    import zipfile
+    from applib import _compression
+    testdir = tempfile.mkdtemp('-test', 'applib-')
+    src = path.join(testdir, 'pkg-1.0')
+    sh.mkdirs(path.join(src, 'sub'))
+    contents = {'a.txt': b'a' * 100000, 'empty.txt': b'',
+                path.join('sub', 'b.png'): os.urandom(5000)}
+    for name, data in contents.items():
+        with open(path.join(src, name), 'wb') as f:
+            f.write(data)
+
+    serial = path.join(testdir, 'serial.zip')
+    sh.pack_archive(serial, ['pkg-1.0'], testdir, 'zip')
+    # force ZIP64 extensions for the parallel one
+    zip64_limit, zipfile.ZIP64_LIMIT = zipfile.ZIP64_LIMIT, 1000
+    try:
+        _compression.ZippedFile.pack(['pkg-1.0'], path.join(
+            testdir, 'parallel.zip'), testdir, workers=3)
+    finally:
+        zipfile.ZIP64_LIMIT = zip64_limit
+
+    for archive in ('serial.zip', 'parallel.zip'):
+        with zipfile.ZipFile(path.join(testdir, archive)) as f:
+            assert f.testzip() is None
+            infos = dict((info.filename, info) for info in f.infolist())
+        assert sorted(infos) == ['pkg-1.0/', 'pkg-1.0/a.txt',
+                                 'pkg-1.0/empty.txt', 'pkg-1.0/sub/',
+                                 'pkg-1.0/sub/b.png']
+        assert infos['pkg-1.0/a.txt'].compress_type == zipfile.ZIP_DEFLATED
+        assert infos['pkg-1.0/sub/b.png'].compress_type == zipfile.ZIP_STORED
+
+        out = tempfile.mkdtemp(dir=testdir)
+        extracted_dir, _ = sh.unpack_archive(path.join(testdir, archive), out)
+        for name, data in contents.items():
+            with open(path.join(extracted_dir, name), 'rb') as f:
+                assert f.read() == data
+    sh.rm(testdir)
+
+
+def test_compression_tar_pack_parallel():
+    import tarfile
+    from applib import _compression
+    testdir = tempfile.mkdtemp('-test', 'applib-')
+    src = path.join(testdir, 'pkg-1.0')
+    sh.mkdirs(src)
+    data = b''.join(os.urandom(100) * 50 for i in range(100))
+    with open(path.join(src, 'data'), 'wb') as f:
+        f.write(data)
+
+    codecs = (_compression._GzipCodec, _compression._Bzip2Codec)
+    block_sizes = [codec.block_size for codec in codecs]
+    for codec in codecs:
+        codec.block_size = 64*1024  # several blocks, for a small file
+    try:
+        for filetype in ('tgz', 'bz2'):
+            archive = path.join(testdir, 'pkg-1.0.' + filetype)
+            sh.pack_archive(archive, ['pkg-1.0'], testdir, filetype, workers=3)
+            with tarfile.open(archive) as f:
+                assert f.extractfile('pkg-1.0/data').read() == data
+            out = tempfile.mkdtemp(dir=testdir)
+            extracted_dir, _ = sh.unpack_archive(archive, out)
+            with open(path.join(extracted_dir, 'data'), 'rb') as f:
+                assert f.read() == data
+    finally:
+        for codec, block_size in zip(codecs, block_sizes):
+            codec.block_size = block_size
+    sh.rm(testdir)
+
+
+def test_compression_xz_zstd():
+    from applib import _compression
+    testdir = tempfile.mkdtemp('-test', 'applib-')
+    for name in ('a/x.txt', 'b/y.txt'):
+        sh.mkdirs(path.dirname(path.join(testdir, 'src', name)))
+        with open(path.join(testdir, 'src', name), 'w') as f:
+            f.write(name * 1000)
+    for filetype, ext, module in [('txz', '.tar.xz', _compression.lzma),
+                                  ('tzst', '.tar.zst', _compression.zstandard)]:
+        archive = path.join(testdir, 'multi-1.0' + ext)
+        if module is None:
+            with pytest.raises(sh.PackError):
+                sh.pack_archive(archive, ['a', 'b'],
+                                path.join(testdir, 'src'), filetype)
+            continue
+        for workers in (1, 2):
+            sh.pack_archive(archive, ['a', 'b'], path.join(testdir, 'src'),
+                            filetype, workers=workers)
+            out = tempfile.mkdtemp(dir=testdir)
+            assert sh.unpack_archive(archive, out) == (
+                path.abspath(path.join(out, 'multi-1.0')), filetype)
+            with open(path.join(out, 'multi-1.0', 'b', 'y.txt')) as f:
+                assert f.read() == 'b/y.txt' * 1000
+    sh.rm(testdir)
+
+
+def test_compression_list_extract_members():
+    testdir = tempfile.mkdtemp('-test', 'applib-')
+    src = path.join(testdir, 'pkg-1.0')
+    sh.mkdirs(path.join(src, 'data'))
+    with open(path.join(src, 'PKG-INFO'), 'w') as f:
+        f.write('Name: pkg')
+    with open(path.join(src, 'data', 'big'), 'wb') as f:
+        f.write(os.urandom(1024*1024))
+    names = ['pkg-1.0', 'pkg-1.0/PKG-INFO', 'pkg-1.0/data', 'pkg-1.0/data/big']
+
+    for filetype in ('tgz', 'zip'):
+        archive = path.join(testdir, 'pkg-1.0.' + filetype)
+        sh.pack_archive(archive, ['pkg-1.0'], testdir, filetype)
+        listed = [name.rstrip('/') for name in sh.list_archive(archive)]
+        assert listed == names
+
+        out = tempfile.mkdtemp(dir=testdir)
+        assert sh.extract_members(archive, ['*/PKG-INFO'], out) == [
+            path.join(out, 'pkg-1.0', 'PKG-INFO')]
+        assert os.listdir(path.join(out, 'pkg-1.0')) == ['PKG-INFO']
+
+    # tarballs are only read up to the requested members
+    truncated = path.join(testdir, 'truncated.tgz')
+    with open(path.join(testdir, 'pkg-1.0.tgz'), 'rb') as f:
+        data = f.read()
+    with open(truncated, 'wb') as f:
+        f.write(data[:len(data) // 2])
+    out = tempfile.mkdtemp(dir=testdir)
+    sh.extract_members(truncated, 'pkg-1.0/PKG-INFO', out)
+    with open(path.join(out, 'pkg-1.0', 'PKG-INFO')) as f:
+        assert f.read() == 'Name: pkg'
+    with pytest.raises(sh.PackError):
+        sh.list_archive(truncated)
+
+    # hard links are extracted along with their targets only
+    if sys.platform != 'win32':
+        os.link(path.join(src, 'PKG-INFO'), path.join(src, 'LINK'))
+        linked = path.join(testdir, 'linked.tgz')
+        sh.pack_archive(linked, ['pkg-1.0'], testdir)
+        # LINK comes first, so PKG-INFO is stored as a hard link to it
+        out = tempfile.mkdtemp(dir=testdir)
+        with pytest.raises(sh.PackError) as excinfo:
+            sh.extract_members(linked, 'pkg-1.0/PKG-INFO', out)
+        assert 'hard link to unextracted member' in str(excinfo.value)
+        out = tempfile.mkdtemp(dir=testdir)
+        sh.extract_members(linked, ['pkg-1.0/LINK', 'pkg-1.0/PKG-INFO'], out)
+        with open(path.join(out, 'pkg-1.0', 'PKG-INFO')) as f:
+            assert f.read() == 'Name: pkg'
+    sh.rm(testdir)
+
+
+def test_compression_extraction_cache():
+    testdir = tempfile.mkdtemp('-test', 'applib-')
+    cache = sh.ExtractionCache(path.join(testdir, 'cache'), max_size=150000,
+                               mode='hardlink')
+    for version in ('1.0', '2.0'):
+        src = path.join(testdir, 'pkg-' + version)
+        sh.mkdirs(src)
+        with open(path.join(src, 'data'), 'wb') as f:
+            f.write(os.urandom(100000))
+        sh.pack_archive(path.join(testdir, 'pkg-{0}.tgz'.format(version)),
+                        ['pkg-' + version], testdir)
+
+    archive = path.join(testdir, 'pkg-1.0.tgz')
+    unpacked = []
+    for i in range(2):
+        out = tempfile.mkdtemp(dir=testdir)
+        extracted_dir, filetype = sh.unpack_archive(archive, out, cache=cache)
+        assert (extracted_dir, filetype) == (
+            path.abspath(path.join(out, 'pkg-1.0')), 'tgz')
+        with open(path.join(extracted_dir, 'data'), 'rb') as f:
+            with open(path.join(testdir, 'pkg-1.0', 'data'), 'rb') as g:
+                assert f.read() == g.read()
+        unpacked.append(path.join(extracted_dir, 'data'))
+    # both are links to the same cached file
+    assert os.stat(unpacked[0]).st_ino == os.stat(unpacked[1]).st_ino
+    assert len(os.listdir(cache.root)) == 1
+
+    # the least recently used entry is evicted
+    sh.unpack_archive(path.join(testdir, 'pkg-2.0.tgz'),
+                      tempfile.mkdtemp(dir=testdir), cache=cache)
+    assert len(os.listdir(cache.root)) == 1
+    assert cache._lookup(path.join(cache.root, os.listdir(cache.root)[0]))[
+        'toplevel'] == 'pkg-2.0'
+
+    # by default, the unpacked files are never the cached ones
+    default = sh.ExtractionCache(path.join(testdir, 'cache2'))
+    assert isinstance(default, sh.ExtractionCache)
+    assert hasattr(sh.ExtractionCache, 'for_application')
+    copies = [path.join(sh.unpack_archive(
+        archive, tempfile.mkdtemp(dir=testdir), cache=default)[0], 'data')
+        for i in range(2)]
+    assert not path.samefile(*copies)
+
+    # entries in use are not evicted
+    from applib._extractcache import _lock
+    entry = path.join(cache.root, os.listdir(cache.root)[0])
+    lock = _lock(entry)
+    if sys.platform != 'win32':
+        assert _lock(entry, exclusive=True) is None
+    sh.unpack_archive(archive, tempfile.mkdtemp(dir=testdir), cache=cache)
+    assert path.exists(entry)
+    lock.close()
+
+    # the directory wrapping several toplevels is named after each archive
+    sh.pack_archive(path.join(testdir, 'foo-1.0.tgz'), ['pkg-1.0', 'pkg-2.0'],
+                    testdir)
+    shutil.copy(path.join(testdir, 'foo-1.0.tgz'),
+                path.join(testdir, 'bar-2.0.tgz'))
+    for name in ('foo-1.0', 'bar-2.0'):
+        out = tempfile.mkdtemp(dir=testdir)
+        extracted_dir, _ = sh.unpack_archive(
+            path.join(testdir, name + '.tgz'), out, cache=cache)
+        assert extracted_dir == path.abspath(path.join(out, name))
+        assert sorted(os.listdir(extracted_dir)) == ['pkg-1.0', 'pkg-2.0']
+    sh.rm(testdir)
+
+
+def test_compression_gzip_index():
+    import sqlite3
+    from contextlib import closing
+    from applib import _compression
+    testdir = tempfile.mkdtemp('-test', 'applib-')
+    src = path.join(testdir, 'pkg-1.0')
+    sh.mkdirs(src)
+    contents = {}
+    for i in range(40):
+        contents['pkg-1.0/f{0}'.format(i)] = os.urandom(2000) * 20
+        with open(path.join(testdir, 'pkg-1.0/f{0}'.format(i)), 'wb') as f:
+            f.write(contents['pkg-1.0/f{0}'.format(i)])
+
+    block_size = _compression._GzipCodec.block_size
+    _compression._GzipCodec.block_size = 64*1024
+    try:
+        sh.pack_archive(path.join(testdir, 'blocks.tgz'), ['pkg-1.0'],
+                        testdir, workers=2)
+    finally:
+        _compression._GzipCodec.block_size = block_size
+    sh.pack_archive(path.join(testdir, 'single.tgz'), ['pkg-1.0'], testdir)
+
+    for name, checkpoints in [('blocks.tgz', 10), ('single.tgz', 1)]:
+        archive = _compression.GzipTarredFile(path.join(testdir, name))
+        index = archive.index(spacing=100000)
+        assert index.is_current()
+        assert index.names() == ['pkg-1.0'] + sorted(contents)
+        with closing(sqlite3.connect(index.path)) as db:
+            count = db.execute('SELECT COUNT(*) FROM checkpoints').fetchone()
+        assert count[0] >= checkpoints
+        for member in ('pkg-1.0/f0', 'pkg-1.0/f23', 'pkg-1.0/f39'):
+            assert index.read(member) == contents[member]
+        with pytest.raises(KeyError):
+            index.read('pkg-1.0/nope')
+    sh.rm(testdir)
+
+
+def test_compression_zip_mapped():
+    import zipfile
+    from applib import _compression
+    testdir = tempfile.mkdtemp('-test', 'applib-')
+    archive = path.join(testdir, 'a.zip')
+    data = os.urandom(1000) * 100
+    with zipfile.ZipFile(archive, 'w') as f:
+        f.writestr('stored', data, zipfile.ZIP_STORED)
+        f.writestr('deflated', data, zipfile.ZIP_DEFLATED)
+
+    with _compression.ZippedFile(archive).mapped(verify_crc=True) as f:
+        view = f.read('stored')
+        assert isinstance(view, memoryview) and view == data
+        view.release()
+        assert f.read('deflated') == data
+        assert b''.join(f.iter_chunks('deflated', 4096)) == data
+
+    # corrupt the last byte of the stored member
+    with open(archive, 'r+b') as f:
+        offset = f.read().index(data) + len(data) - 1
+        f.seek(offset)
+        f.write(b'!' if data[-1:] != b'!' else b'?')
+    with _compression.ZippedFile(archive).mapped() as f:
+        f.read('stored').release()  # not verified
+    with _compression.ZippedFile(archive).mapped(verify_crc=True) as f:
+        with pytest.raises(sh.PackError):
+            f.read('stored')
+    sh.rm(testdir)
+
+
+def test_compression_verify_archive():
+    import io
+    from contextlib import closing
+    import tarfile
+    import zipfile
+    from applib import _compression
+    testdir = tempfile.mkdtemp('-test', 'applib-')
+    src = path.join(testdir, 'pkg-1.0')
+    sh.mkdirs(src)
+    data = os.urandom(1000) * 10
+    with open(path.join(src, 'data'), 'wb') as f:
+        f.write(data)
+
+    good = []
+    for filetype in ('tgz', 'bz2', 'zip'):
+        good.append(path.join(testdir, 'pkg-1.0.' + filetype))
+        sh.pack_archive(good[-1], ['pkg-1.0'], testdir, filetype)
+        assert sh.verify_archive(good[-1]) == filetype
+
+    if _compression.zstandard is not None:
+        # the data is checked against the content checksum of the frames
+        good.append(path.join(testdir, 'pkg-1.0.tzst'))
+        sh.pack_archive(good[-1], ['pkg-1.0'], testdir, 'tzst')
+        assert sh.verify_archive(good[-1]) == 'tzst'
+        corrupt_zst = path.join(testdir, 'corrupt.tzst')
+        with open(good[-1], 'rb') as f:
+            zst = bytearray(f.read())
+        zst[len(zst) // 2] ^= 0xff  # in the compressed data
+        with open(corrupt_zst, 'wb') as f:
+            f.write(zst)
+        with pytest.raises(sh.PackError):
+            sh.verify_archive(corrupt_zst)
+
+    corrupt = path.join(testdir, 'corrupt.zip')
+    with zipfile.ZipFile(corrupt, 'w') as f:
+        f.writestr('pkg/data', data, zipfile.ZIP_STORED)
+    with open(corrupt, 'r+b') as f:
+        f.seek(f.read().index(data) + 10)
+        f.write(b'!' if data[10:11] != b'!' else b'?')
+
+    unsafe = path.join(testdir, 'unsafe.tgz')
+    with closing(tarfile.open(unsafe, 'w:gz')) as f:
+        info = tarfile.TarInfo('pkg/../../evil')
+        info.size = 4
+        f.addfile(info, io.BytesIO(b'evil'))
+
+    single = path.join(testdir, 'single.tgz')
+    with closing(tarfile.open(single, 'w:gz')) as f:
+        f.add(path.join(src, 'data'), 'data')
+
+    multi = path.join(testdir, 'multi.zip')
+    with zipfile.ZipFile(multi, 'w') as f:
+        f.writestr('a/x', 'x')
+        f.writestr('b/y', 'y')
+    assert sh.verify_archive(multi) == 'zip'
+    with pytest.raises(_compression.MultipleTopLevels):
+        sh.verify_archive(multi, single_toplevel=True)
+
+    errors = sh.verify_archives(good + [corrupt, unsafe, single],
+                                max_workers=2)
+    assert [errors[filename] for filename in good] == [None] * len(good)
+    assert isinstance(errors[corrupt], sh.PackError)
+    assert 'unsafe member path' in str(errors[unsafe])
+    assert isinstance(errors[single], _compression.SingleFile)
+    sh.rm(testdir)
+
+
+def test_simpledb_bulk_upsert():
+    pytest.importorskip('sqlalchemy')
+    from sqlalchemy import Table, Column, MetaData
+    from applib import _simpledb
+
+    class Package(_simpledb.SimpleObject):
+        FIELDS = ['name', 'version', 'summary', 'install_requires']
+
+    # bulk_insert and bulk_upsert only use the table, so it is set up by hand
+    # rather than with _simpledb.setup (whose classical mapping is gone in
+    # SQLAlchemy 2.0)
+    class PackageDatabase(_simpledb.SimpleDatabase):
+        metadata = MetaData()
+        table = Table('Package', metadata, *[
+            Column(name, _simpledb._get_best_column_type(name),
+                   primary_key=name in ('name', 'version'))
+            for name in Package.FIELDS])
+
+    testdir = tempfile.mkdtemp('-test', 'applib-')
+    db = PackageDatabase(path.join(testdir, 'packages.db'), touch=True)
+    rows = [dict(name='pkg{0}'.format(i), version='1.0', summary='old',
+                 install_requires=['six']) for i in range(1000)]
+    assert db.bulk_insert(rows, chunk_size=300) == 1000
+    assert db.bulk_upsert([dict(row, summary='new') for row in rows[:10]]) == 10
+    assert db.bulk_upsert([Package(name='pkg0', version='2.0', summary='v2',
+                                   install_requires=[])], key=['name']) == 1
+    # the last of the rows with the same key wins, whatever the chunk size
+    for chunk_size in (1, 10):
+        db.bulk_upsert([dict(name='dup', version=version, summary='',
+                             install_requires=[]) for version in ('3', '4')],
+                       key=['name'], chunk_size=chunk_size)
+
+    conn = db.engine.connect()
+    try:
+        packages = conn.execute(PackageDatabase.table.select()).fetchall()
+    finally:
+        conn.close()
+    assert len(packages) == 1001
+    assert [tuple(p[:2]) for p in packages if p[0] == 'dup'] == [('dup', '4')]
+    by_name = dict((p[0], p) for p in packages)
+    assert tuple(by_name['pkg0'][1:3]) == ('2.0', 'v2')
+    assert by_name['pkg1'][2] == 'new'
+    assert by_name['pkg999'][3] == ['six']
+    db.close()
+    sh.rm(testdir)
+
+
 @skipif('sys.platform != "win32"')
 def test_compression_windows_syntax_incorrect():
     """
@@ -39,6 +39,9 @@ setup(name='applib',
       include_package_data=True,
       zip_safe=True,
       install_requires=[
-          'appdirs', 'six>=1.0.0',
+          'appdirs', 'six>=1.0.0', 'scandir; python_version < "3.5"',
       ],
+      extras_require={
+          'zstd': ['zstandard'],
+      },
       )